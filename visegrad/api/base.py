@@ -1,14 +1,38 @@
 from scrapy.conf import settings
 import scrapy.log
-from scrapy.log import INFO, DEBUG
+from scrapy.log import INFO, DEBUG, ERROR
 
 import vpapi
 
+import requests
+
 import json
 
 import os
 
-from visegrad.utils import chunks
+import urllib
+
+import threading
+
+import collections
+
+import Queue
+
+import traceback
+
+import time
+
+import itertools
+
+from datetime import datetime
+
+from multiprocessing.pool import ThreadPool
+
+from visegrad.utils import chunks, make_dirs
+from visegrad.api.identity import IdentityMap, content_hash
+from visegrad.api.checkpoint import Checkpoint
+from visegrad.api.reader import JsonLinesIndex, SortedJsonLines
+from visegrad.api.batching import AdaptiveBatchSize
 
 
 class VisegradApiExport(object):
@@ -17,8 +41,17 @@ class VisegradApiExport(object):
     user = 'scraper'
     parliament_code = ''
     single_chamber = True
-    motions_ids = {}
-    events_ids = {}
+    lookup_chunk_size = 50
+    # maximum length of URL encoded `where` of a lookup query, long query
+    # strings are refused by web servers
+    lookup_max_query_length = 3000
+    batch_size = 100
+    votes_batch_size = 400
+    votes_sort_buffer_size = 100000
+    batch_max_bytes = 1024 * 1024
+    batch_target_latency = 2.0
+    index_page_size = 50
+    checkpoint_interval = 10
 
     PEOPLE_FILE = 'Person.json'
     ORGANIZATIONS_FILE = 'Organization.json'
@@ -39,12 +72,91 @@ class VisegradApiExport(object):
         'speeches': SPEECHES_FILE,
     }
 
+    # export stages as (name, method, inputs, outputs), a stage starts
+    # when all stages producing its inputs have finished
+    STAGES = (
+        ('people', 'export_people', (), ('people',)),
+        ('organizations', 'export_organizations', (), ('organizations',)),
+        ('index', 'index_remote_ids', ('people', 'organizations'), ('ids',)),
+        ('memberships', 'export_memberships', ('ids',), ()),
+        ('events', 'export_events', (), ('events_ids',)),
+        ('motions', 'export_motions', ('events_ids',), ('motions_ids',)),
+        ('votes', 'export_votes', ('ids', 'events_ids', 'motions_ids'), ()),
+        ('speeches', 'export_speeches', ('ids', 'events_ids'), ()),
+    )
+
+    # stages which are not streamed during the crawl but exported from
+    # the files when it has finished (see `StreamingExportPipeline`)
+    stream_deferred = ()
+
+    # top-level fields of the input files by which their lines are indexed
+    INDEXED_FIELDS = {
+        'events': ('parent_id',),
+    }
+
+    # fields of the natural keys of documents, see `get_natural_keys()`
+    LOOKUP_FIELDS = {
+        'memberships': ('person_id', 'organization_id', 'start_date'),
+        'motions': ('sources',),
+        'speeches': ('sources',),
+        'vote-events': ('motion_id', 'start_date'),
+        'votes': ('vote_event_id', 'voter_id'),
+        'events': ('identifier',),
+    }
+
+    # statuses of API responses rejecting the exported item itself, other
+    # errors fail the stage
+    REJECTED_STATUSES = (400, 422)
+
+    # maps of local to remote ids saved along with the checkpoint
+    CHECKPOINT_MAPS = ('events_ids', 'motions_ids')
+
     def __init__(self, log = None):
-        vpapi.parliament(self.get_parliament())
-        vpapi.authorize(self.get_user(), self.get_password())
+        cache = None
+        if settings.getint('VPAPI_CACHE_SIZE'):
+            cache = vpapi.ResponseCache(
+                settings.getint('VPAPI_CACHE_SIZE'),
+                settings.getint('VPAPI_CACHE_TTL', 300)
+            )
+        rate_limiter = None
+        if settings.getfloat('VPAPI_RATE_LIMIT'):
+            rate_limiter = vpapi.RateLimiter(
+                settings.getfloat('VPAPI_RATE_LIMIT'))
+        self.api = vpapi.Client(
+            self.get_parliament(),
+            (self.get_user(), self.get_password()),
+            pool_maxsize=max(
+                settings.getint('VPAPI_POOL_SIZE', 10), self.get_concurrency()),
+            cache=cache,
+            retry=vpapi.RetryPolicy(settings.getint('VPAPI_RETRIES', 5)),
+            rate_limiter=rate_limiter,
+            compress_threshold=settings.getint('VPAPI_COMPRESS_THRESHOLD') or None
+        )
+        self.api.metrics.add_callback(self.count_request)
+        self.api.thread_context = self.get_thread_context
 
         self._chamber = None
+        self._chamber_lock = threading.Lock()
         self._ids = {}
+        self._indexed = set()
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self.stats = {}
+        self.identity = IdentityMap(self.get_output_filename('ids.sqlite'))
+        self.motions_ids = {}
+        self.events_ids = {}
+        self.checkpoint = Checkpoint(
+            self.get_output_filename('checkpoint.json'),
+            [self.get_filename(source) for source in sorted(self.FILES)]
+        )
+        self._positions = {}
+        self._indexes = {}
+        self._indexes_lock = threading.Lock()
+        self._batch_sizes = {}
+        self._batch_sizes_lock = threading.Lock()
+        self.started = time.time()
+        self.report = None
+        self._checkpoint_saved = 0
         if log is None:
             self.log = scrapy.log.msg
         else:
@@ -56,43 +168,342 @@ class VisegradApiExport(object):
     def get_user(self):
         return self.user
 
+    def get_output_filename(self, suffix):
+        """Returns name of the file of the export with the given suffix,
+        next to the exported data.
+        """
+        filename = '%s.%s' % (self.get_parliament().replace('/', '_'), suffix)
+        return os.path.join(
+            settings.get('OUTPUT_PATH', ''), self.domain, filename)
+
+    def get_filename(self, source):
+        return os.path.join(
+            settings.get('OUTPUT_PATH', ''),
+            self.domain,
+            self.FILES[source]
+        )
+
     def get_password(self):
         var = 'VPAPI_PWD_%s' % self.parliament_code.upper()
         return settings.get(var)
 
-    def run_export(self):
-        self.log('Exporting people', INFO)
-        self.export_people()
-        self.log('Exporting organizations', INFO)
-        self.export_organizations()
-        self.log('Exporting memberships', INFO)
-        self.export_memberships()
-        self.log('Exporting events', INFO)
-        self.export_events()
-        self.log('Exporting motions', INFO)
-        self.export_motions()
-        self.log('Exporting votes', INFO)
-        self.export_votes()
-        self.log('Exporting speeches', INFO)
-        self.export_speeches()
-
-    def load_json(self, source, exclude=None):
+    def run_export(self, resume=None):
+        """Exports the scraped files. In resume mode (`VPAPI_EXPORT_RESUME`
+        setting by default) the export continues from the checkpoint of
+        the last failed export of the same files.
+        """
+        if resume is None:
+            resume = settings.getbool('VPAPI_EXPORT_RESUME', False)
+        if resume and self.checkpoint.load():
+            self.log('Resuming export from %s' % self.checkpoint.filename,
+                     INFO)
+            for name in self.CHECKPOINT_MAPS:
+                getattr(self, name).update(self.checkpoint.maps.get(name, {}))
+        else:
+            self.checkpoint.clear()
+
+        self.started = time.time()
+        status = 'failed'
+        try:
+            self.run_stages(self.STAGES)
+            self.checkpoint.clear()
+            status = 'finished'
+        finally:
+            self.identity.close()
+            for index in self._indexes.values():
+                index.close()
+            self._indexes = {}
+            self.dump_metrics()
+            self.write_report(status)
+            if self.api.cache is not None:
+                self.log('API cache: %(hits)d hits, %(misses)d misses, \
+%(revalidations)d revalidations' % self.api.cache.stats(), INFO)
+
+    def dump_metrics(self):
+        """Writes metrics of API requests by endpoint into a JSON file
+        next to the exported data.
+        """
+        filename = self.get_output_filename('metrics.json')
+        make_dirs(filename)
+        self.api.metrics.dump(filename)
+
+    def write_report(self, status):
+        """Makes report of the export with counters, wall time and speed of
+        each stage, writes it into a JSON file next to the exported data
+        and returns it.
+        """
+        stages = {}
+        for name, stats in self.stats.items():
+            stage = dict(stats)
+            processed = sum(
+                stats[k] for k in ('created', 'updated', 'skipped', 'failed'))
+            stage['items_per_second'] = \
+                processed / stats['seconds'] if stats['seconds'] else None
+            stages[name or 'other'] = stage
+        self.report = {
+            'parliament': self.get_parliament(),
+            'status': status,
+            'started': datetime.utcfromtimestamp(self.started).isoformat(),
+            'seconds': time.time() - self.started,
+            'stages': stages,
+        }
+
+        filename = self.get_output_filename('report.json')
+        make_dirs(filename)
+        with open(filename, 'w') as f:
+            json.dump(self.report, f, indent=2, sort_keys=True)
+        return self.report
+
+    def run_stages(self, stages):
+        """Runs each of the stages as soon as the stages producing its
+        inputs have finished. Independent stages run in parallel threads
+        unless `VPAPI_EXPORT_PARALLEL_STAGES` setting is off.
+        Stages depending on a failed stage are skipped and the first
+        error is raised when no other stage can run.
+        """
+        producers = {}
+        for name, method, inputs, outputs in stages:
+            for output in outputs:
+                producers[output] = name
+        requires = dict(
+            (name, set(producers[i] for i in inputs))
+            for name, method, inputs, outputs in stages
+        )
+        parallel = settings.getbool('VPAPI_EXPORT_PARALLEL_STAGES', True)
+
+        finished = Queue.Queue()
+        waiting = [(name, method) for name, method, i, o in stages]
+        running = set()
+        done = set()
+        errors = []
+
+        def run(name, method):
+            error = None
+            try:
+                if self.checkpoint.is_finished(name):
+                    self.log('Skipping %s, exported before' % name, INFO)
+                    return
+                try:
+                    self.run_stage(name, getattr(self, method))
+                    self.checkpoint.finish(name)
+                finally:
+                    self.save_checkpoint(name, force=True)
+            except Exception, e:
+                self.log(traceback.format_exc(), ERROR)
+                error = e
+            finally:
+                # the main loop waits for each started stage
+                finished.put((name, error))
+
+        while waiting or running:
+            progress = False
+            for name, method in list(waiting):
+                if not requires[name] <= done:
+                    if requires[name] & set(e[0] for e in errors):
+                        self.log('Skipping %s' % name, ERROR)
+                        errors.append((name, None))
+                        waiting.remove((name, method))
+                        progress = True
+                    continue
+                if running and not parallel:
+                    break
+                waiting.remove((name, method))
+                running.add(name)
+                progress = True
+                if parallel:
+                    thread = threading.Thread(target=run, args=(name, method))
+                    thread.daemon = True
+                    thread.start()
+                else:
+                    run(name, method)
+            if not running:
+                if not progress:
+                    # there is nothing to wait for, the rest cannot run
+                    break
+                continue
+            name, error = finished.get()
+            running.remove(name)
+            if error is None:
+                done.add(name)
+            else:
+                errors.append((name, error))
+
+        for name, error in errors:
+            if error is not None:
+                raise error
+
+    def get_stage(self):
+        """Returns name of the stage being run by the current thread."""
+        return getattr(self._local, 'stage', None)
+
+    def get_thread_context(self):
+        """Returns function setting the stage of the current thread in
+        other threads started by it, see `vpapi.Client.thread_context`.
+        """
+        stage = self.get_stage()
+
+        def set_stage():
+            self._local.stage = stage
+        return set_stage
+
+    def run_stage(self, name, func):
+        self.log('Exporting %s' % name, INFO)
+        self._local.stage = name
+        started = time.time()
+        try:
+            func()
+        finally:
+            self.count('seconds', time.time() - started)
+        stats = self.get_stats(name)
+        self.log('Exported %s: %d created, %d updated, %d skipped, \
+%d failed' % (name, stats['created'], stats['updated'], stats['skipped'],
+            stats['failed']), INFO)
+        if stats['errors']:
+            raise Exception(
+                'Exporting %s failed with %d errors' % (name, stats['errors']))
+
+    def get_concurrency(self):
+        return max(settings.getint('VPAPI_EXPORT_CONCURRENCY', 1), 1)
+
+    def for_each(self, func, tasks):
+        """Calls `func` for each of the tasks, concurrently by the number
+        of worker threads given by `VPAPI_EXPORT_CONCURRENCY` setting.
+        Errors are logged and counted into the stage stats instead of
+        interrupting the other tasks.
+        """
+        workers = self.get_concurrency()
+        stage = self.get_stage()
+        positions = self._positions.setdefault(stage, {})
+        # input files are checkpointed up to the first failed task
+        progress = [True]
+
+        def done(succeeded, offsets):
+            progress[0] = progress[0] and succeeded
+            if progress[0]:
+                self.save_checkpoint(stage, offsets)
+
+        if workers == 1:
+            for task in tasks:
+                done(self._call(func, task, stage), dict(positions))
+            return
+
+        thread_pool = ThreadPool(workers)
+        pending = collections.deque()
+        try:
+            for task in tasks:
+                pending.append((
+                    thread_pool.apply_async(self._call, (func, task, stage)),
+                    dict(positions)
+                ))
+                while len(pending) >= 2 * workers:
+                    result, offsets = pending.popleft()
+                    done(result.get(), offsets)
+            while pending:
+                result, offsets = pending.popleft()
+                done(result.get(), offsets)
+        finally:
+            thread_pool.close()
+            thread_pool.join()
+
+    def _call(self, func, task, stage):
+        self._local.stage = stage
+        try:
+            func(task)
+            return True
+        except Exception:
+            self.log(traceback.format_exc(), ERROR)
+            self.count('errors')
+            return False
+
+    def save_checkpoint(self, stage, offsets=None, force=False):
+        """Records offsets of the input files exported by the stage. The
+        checkpoint is written at most once per `checkpoint_interval`
+        seconds unless `force` is set.
+        """
+        if offsets:
+            self.checkpoint.set_offsets(stage, offsets)
+        now = time.time()
+        if force or now - self._checkpoint_saved >= self.checkpoint_interval:
+            self._checkpoint_saved = now
+            self.checkpoint.save(dict(
+                (name, getattr(self, name)) for name in self.CHECKPOINT_MAPS))
+
+    def get_stats(self, stage=None):
+        """Returns counters of read, created, updated, skipped and failed
+        items, of API requests and wall time of the export stage.
+        """
+        with self._stats_lock:
+            return self.stats.setdefault(stage, {
+                'created': 0, 'updated': 0, 'skipped': 0, 'failed': 0,
+                'errors': 0, 'read': 0, 'requests': 0, 'bytes_sent': 0,
+                'bytes_received': 0, 'seconds': 0.0})
+
+    def count(self, kind, n=1):
+        stats = self.get_stats(self.get_stage())
+        with self._stats_lock:
+            stats[kind] += n
+
+    def count_request(self, method, resource, status, latency, sent,
+                      received):
+        """Attributes the API request to the stage of the current thread."""
+        stats = self.get_stats(self.get_stage())
+        with self._stats_lock:
+            stats['requests'] += 1
+            stats['bytes_sent'] += sent
+            stats['bytes_received'] += received
+
+    def get_index(self, source):
+        """Returns index of the source file by its `INDEXED_FIELDS`, built
+        on the first use.
+        """
+        with self._indexes_lock:
+            if source not in self._indexes:
+                self._indexes[source] = JsonLinesIndex(
+                    self.get_filename(source),
+                    self.INDEXED_FIELDS.get(source, ()))
+            return self._indexes[source]
+
+    def load_json(self, source, exclude=None, reader=None, field=None,
+                  values=None):
+        """Yields items of the source file, from the checkpointed offset of
+        the `reader` (the source by default) in the current stage.
+
+        When `field` is given, only items whose value of the field is one
+        of the `values` are read, using the index of the file.
+        """
         if exclude is None:
             exclude = lambda x: False
+        if reader is None:
+            reader = source
 
-        filename = os.path.join(
-            settings.get('OUTPUT_PATH', ''),
-            self.domain,
-            self.FILES[source]
-        )
+        stage = self.get_stage()
+        positions = self._positions.setdefault(stage, {})
+        offset = self.checkpoint.get_offset(stage, reader)
+        if field is not None:
+            index = self.get_index(source)
+            for end, item in index.items(field, values, start=offset):
+                positions[reader] = end
+                if not exclude(item):
+                    self.count('read')
+                    yield item
+            return
+
+        filename = self.get_filename(source)
         if os.path.exists(filename):
             with open(filename, 'r') as f:
-                for line in f:
+                f.seek(offset)
+                for line in iter(f.readline, ''):
+                    offset += len(line)
+                    positions[reader] = offset
                     item = json.loads(line.rstrip())
                     if not exclude(item):
+                        self.count('read')
                         yield item
 
-    def get_or_create(self, endpoint, item, refresh=False, where_keys=None):
+    def get_lookup(self, endpoint, item, where_keys=None):
+        """Returns `where`, `sort` and `embed` parameters of the query
+        finding already exported `item`.
+        """
         sort = []
         embed = []
         where = {}
@@ -110,7 +521,6 @@ class VisegradApiExport(object):
         elif endpoint in ('motions', 'speeches'):
             where = {'sources.url': item['sources'][0]['url']}
         elif endpoint == 'vote-events':
-            embed = ['votes']
             if 'motion_id' in item:
                 where = {'motion_id': item['motion_id']}
             else:
@@ -125,180 +535,676 @@ class VisegradApiExport(object):
         else:
             where = {
                 'identifiers': {'$elemMatch': item['identifiers'][0]}}
+        return where, sort, embed
+
+    def get_natural_keys(self, endpoint, item, where_keys=None):
+        """Returns list of natural keys the item (or document returned by
+        the API) can be found by. The first one corresponds to the query
+        returned by `get_lookup()`.
+        """
+        if where_keys:
+            return [tuple(item.get(k) for k in where_keys)]
+        elif endpoint == 'memberships':
+            return [(
+                item.get('person_id'),
+                item.get('organization_id'),
+                item.get('start_date')
+            )]
+        elif endpoint in ('motions', 'speeches'):
+            return [s['url'] for s in item.get('sources', [])]
+        elif endpoint == 'vote-events':
+            keys = []
+            if 'motion_id' in item:
+                keys.append(('motion_id', item['motion_id']))
+            if 'start_date' in item:
+                keys.append(('start_date', item['start_date']))
+            return keys
+        elif endpoint == 'votes':
+            return [(item.get('vote_event_id'), item.get('voter_id'))]
+        elif endpoint == 'events':
+            return [item.get('identifier')]
+        else:
+            return [
+                (i.get('scheme'), i['identifier'])
+                for i in item.get('identifiers', [])
+            ]
+
+    def get_projection(self, endpoint, items=(), where_keys=None):
+        """Returns fields of documents read by lookups of the items: id,
+        fields of their natural keys and, in patch mode, fields compared
+        with the items.
+        """
+        if where_keys:
+            fields = set(where_keys)
+        else:
+            fields = set(self.LOOKUP_FIELDS.get(endpoint, ('identifiers',)))
+        fields.add('id')
+        if self.get_update_mode() == 'patch':
+            for item in items:
+                fields.update(item)
+        return sorted(fields)
+
+    def find_existing(self, endpoint, items, where_keys=None):
+        """Looks up already exported items by their natural keys using
+        one query per `lookup_chunk_size` items.
+        Returns dictionary mapping natural key to the found document.
+        """
+        found = {}
+        for items_chunk in chunks(items, self.lookup_chunk_size):
+            wheres = []
+            sort = []
+            for item in items_chunk:
+                where, sort, embed = self.get_lookup(endpoint, item, where_keys)
+                if where not in wheres:
+                    wheres.append(where)
+
+            projection = self.get_projection(endpoint, items_chunk, where_keys)
+            for where in self.combine_lookups(wheres):
+                for doc in self.api.getall(
+                        endpoint, where=where, sort=sort,
+                        projection=projection):
+                    for key in self.get_natural_keys(
+                            endpoint, doc, where_keys):
+                        found.setdefault(key, doc)
+        return found
+
+    def combine_lookups(self, wheres):
+        """Yields queries finding documents matched by any of the `wheres`,
+        each at most `lookup_max_query_length` long when URL encoded
+        unless a single one of the `wheres` is longer.
+        """
+        group = []
+        length = 0
+        for where in wheres:
+            # separator of the conditions is encoded as '%2C+'
+            where_length = len(urllib.quote_plus(json.dumps(where))) + 4
+            if group and length + where_length > self.lookup_max_query_length:
+                yield self.combine_lookup_group(group)
+                group = []
+                length = 0
+            group.append(where)
+            length += where_length
+        if group:
+            yield self.combine_lookup_group(group)
+
+    def combine_lookup_group(self, wheres):
+        fields = set(k for w in wheres for k in w)
+        if len(fields) == 1 and \
+                all(not isinstance(w.values()[0], dict) for w in wheres):
+            field = fields.pop()
+            return {field: {'$in': [w[field] for w in wheres]}}
+        elif len(wheres) == 1:
+            return wheres[0]
+        return {'$or': wheres}
+
+    def get_or_create(self, endpoint, item, refresh=False, where_keys=None):
+        where, sort, embed = self.get_lookup(endpoint, item, where_keys)
+        existing = self.api.getfirst(
+            endpoint, where=where, sort=sort,
+            projection=self.get_projection(endpoint, [item], where_keys))
+        return self.save(endpoint, item, existing, refresh, sort, embed)
+
+    def get_or_create_many(self, endpoint, items, where_keys=None):
+        """Batched variant of `get_or_create()`. Existing items are looked
+        up by a single query per chunk and replaced one by one, new items
+        are created by list POST requests of size adapted by
+        `get_batch_size()`.
+        Returns list of responses in the order of `items`, failed items
+        have None in place of the response.
+        """
+        keys = [
+            self.get_natural_keys(endpoint, item, where_keys)[0]
+            for item in items
+        ]
+        existing = dict(
+            (key, {'id': pk})
+            for key, pk in self.identity.get_many(endpoint, keys).items()
+        )
+        hashes = [content_hash(item) for item in items]
+        if settings.getbool('VPAPI_SKIP_UNCHANGED', True):
+            exported_hashes = self.identity.get_hashes(endpoint, keys)
+        else:
+            exported_hashes = {}
+        if self.get_update_mode() == 'patch':
+            # changed items are diffed against their current documents
+            changed = [
+                key for key, h in zip(keys, hashes)
+                if key in existing and exported_hashes.get(key) != h
+            ]
+            docs = self.fetch_by_ids(
+                endpoint, [existing[key]['id'] for key in changed],
+                self.get_projection(endpoint, items, where_keys))
+            for key in changed:
+                if existing[key]['id'] in docs:
+                    existing[key] = docs[existing[key]['id']]
+                else:
+                    self.identity.delete(endpoint, key)
+                    del existing[key]
+        unknown = [
+            item for item, key in zip(items, keys) if key not in existing]
+        if unknown:
+            existing.update(self.find_existing(endpoint, unknown, where_keys))
+        results = [None] * len(items)
+        to_create = []
+        new_keys = {}
+        duplicates = []
+
+        for n, (item, key) in enumerate(zip(items, keys)):
+            if key in existing and exported_hashes.get(key) == hashes[n]:
+                # unchanged since the last export
+                results[n] = {'id': existing[key]['id'], '_created': False}
+                self.count('skipped')
+            elif key in existing:
+                results[n] = self.update(
+                    endpoint, item, existing[key], key, where_keys)
+            elif key in new_keys:
+                duplicates.append((n, new_keys[key]))
+            else:
+                new_keys[key] = n
+                to_create.append(n)
+
+        created = self.batch_create(endpoint, [items[n] for n in to_create])
+        for n, resp in zip(to_create, created):
+            results[n] = resp
+
+        # items with the same natural key replace the just created one
+        for n, first in duplicates:
+            if results[first] is not None:
+                results[n] = self.update(endpoint, items[n], results[first])
+                if results[n] is not None:
+                    results[n]['_created'] = False
+
+        self.identity.set_many(endpoint, dict(
+            (key, resp['id'])
+            for key, resp in zip(keys, results) if resp is not None
+        ))
+        self.identity.set_hashes(endpoint, dict(
+            (key, h)
+            for key, h, resp in zip(keys, hashes, results) if resp is not None
+        ))
+        return results
+
+    def update(self, endpoint, item, existing, key=None, where_keys=None):
+        """Replaces `existing` document by the item.
+        Returns the response or None if the API rejected the item, other
+        errors of the API are raised.
+        """
+        try:
+            return self.save(endpoint, item, existing)
+        except requests.HTTPError, e:
+            error = e
+        if error.response.status_code == 404 and key is not None:
+            # remembered document does not exist anymore
+            self.identity.delete(endpoint, key)
+            try:
+                return self.get_or_create(
+                    endpoint, item, where_keys=where_keys)
+            except requests.HTTPError, e:
+                error = e
+        if error.response.status_code not in self.REJECTED_STATUSES:
+            raise error
+        self.log_failed(endpoint, item, self.get_error(error))
+
+    def save(self, endpoint, item, existing, refresh=False, sort=None,
+             embed=None):
+        """Creates the item or replaces `existing` document by it."""
         created = False
-        resp = vpapi.getfirst(endpoint, where=where, sort=sort)
-        if not resp:
-            resp = vpapi.post(endpoint, item)
+        if not existing:
+            resp = self.api.post(endpoint, item)
             created = True
             self.log('Created %s' % resp['_links']['self']['href'], DEBUG)
+        elif self.get_update_mode() == 'patch':
+            pk = existing['id']
+            delta = self.get_delta(item, existing)
+            if delta:
+                resp = self.api.patch("%s/%s" % (endpoint, pk), delta)
+                self.log('Updated %s' % resp['_links']['self']['href'], DEBUG)
+            else:
+                resp = {
+                    '_status': 'OK',
+                    'id': pk,
+                    '_links': {'self': {'href': "%s/%s" % (endpoint, pk)}},
+                    '_skipped': True,
+                }
         else:
-            pk = resp['id']
-            resp = vpapi.put("%s/%s" % (endpoint, pk), item)
+            pk = existing['id']
+            resp = self.api.put("%s/%s" % (endpoint, pk), item)
             self.log('Updated %s' % resp['_links']['self']['href'], DEBUG)
 
         if resp['_status'] != 'OK':
             raise Exception(resp)
+        if resp.pop('_skipped', False):
+            self.count('skipped')
+        else:
+            self.count('created' if created else 'updated')
         if refresh:
-            resp = vpapi.get(
-                resp['_links']['self']['href'], sort=sort, embed=embed)
+            resp = self.api.get(
+                resp['_links']['self']['href'], sort=sort or [],
+                embed=embed or [])
         resp['_created'] = created
         return resp
 
-    def batch_create(self, endpoint, items):
-        resp = vpapi.post(endpoint, items)
-        if resp['_status'] != 'OK':
-            raise Exception(resp)
-        self.log('Created %d items' % len(resp['_items']), DEBUG)
-        return
+    def get_update_mode(self):
+        """Returns 'put' if existing documents are replaced by exported
+        items or 'patch' if only their changed fields are updated.
+        """
+        return settings.get('VPAPI_UPDATE_MODE', 'put')
+
+    def get_delta(self, item, existing):
+        """Returns fields of the item differing from the existing document.
+        Fields of the document missing in the item are kept, PATCH cannot
+        remove them.
+        """
+        return dict(
+            (k, v) for k, v in item.items()
+            if k not in existing or existing[k] != v
+        )
+
+    def fetch_by_ids(self, endpoint, ids, fields=None):
+        """Returns dictionary of documents with the given ids, fetched by
+        one query per `lookup_chunk_size` ids at most. Only the given fields are
+        returned if any.
+        """
+        params = {}
+        if fields:
+            params['projection'] = fields
+        docs = {}
+        for ids_chunk in chunks(ids, self.lookup_chunk_size):
+            wheres = [{'id': id} for id in ids_chunk]
+            for where in self.combine_lookups(wheres):
+                for doc in self.api.getall(endpoint, where=where, **params):
+                    docs[doc['id']] = doc
+        return docs
+
+    def get_batch_size(self, endpoint, batch_size=None):
+        """Returns adaptive size of list requests to the endpoint, starting
+        at `batch_size` items.
+        """
+        with self._batch_sizes_lock:
+            if endpoint not in self._batch_sizes:
+                self._batch_sizes[endpoint] = AdaptiveBatchSize(
+                    batch_size or self.batch_size,
+                    max_bytes=self.batch_max_bytes,
+                    target_latency=self.batch_target_latency
+                )
+            return self._batch_sizes[endpoint]
+
+    def batches(self, endpoint, items, batch_size=None):
+        """Yields chunks of the items of the current size of list requests
+        to the endpoint, so that the chunks follow its adaptation.
+        """
+        size = self.get_batch_size(endpoint, batch_size)
+        items = iter(items)
+        chunk = list(itertools.islice(items, size.size))
+        while chunk:
+            yield chunk
+            chunk = list(itertools.islice(items, size.size))
+
+    def batch_create(self, endpoint, items, batch_size=None):
+        """Creates the items by list POST requests. Their size starts at
+        `batch_size` items and adapts to latency of the API, see
+        `AdaptiveBatchSize`. Items rejected by the API are logged and
+        skipped, the rest of their batch is sent again.
+        Returns list of responses in the order of `items`, failed items
+        have None in place of the response.
+        """
+        size = self.get_batch_size(endpoint, batch_size)
+        sizes = [len(json.dumps(item)) for item in items]
+        results = []
+        start = 0
+        while start < len(items):
+            end = size.split(sizes, start)
+            results.extend(self._batch_create(
+                endpoint, items[start:end], size, sum(sizes[start:end])))
+            start = end
+        return results
+
+    def _batch_create(self, endpoint, items, size, length):
+        started = time.time()
+        try:
+            resp = self.api.post(endpoint, items)
+            size.record(len(items), time.time() - started)
+        except requests.HTTPError, e:
+            status = e.response.status_code
+            if status == 413:
+                size.shrink(length)
+            # only errors caused by the items are worth isolating
+            if status not in self.REJECTED_STATUSES + (413,):
+                raise
+            try:
+                resp = self.get_list_response(e.response.json(), items)
+            except ValueError:
+                resp = {'_status': 'ERR', '_error': {
+                    'code': status, 'message': str(e)}}
+            if not isinstance(resp.get('_items'), list) or \
+                    len(resp['_items']) != len(items):
+                return self._bisect(endpoint, items, resp)
+        else:
+            resp = self.get_list_response(resp, items)
+
+        if resp['_status'] == 'OK':
+            self.log('Created %d items' % len(resp['_items']), DEBUG)
+            self.count('created', len(resp['_items']))
+            for r in resp['_items']:
+                r['_created'] = True
+            return resp['_items']
+
+        # the API creates none of the items if any of them is invalid
+        valid = []
+        for item, r in zip(items, resp['_items']):
+            if r.get('_status') == 'OK':
+                valid.append(item)
+            else:
+                self.log_failed(endpoint, item, r)
+        created = iter(self.batch_create(endpoint, valid) if valid else [])
+        return [
+            next(created) if r.get('_status') == 'OK' else None
+            for r in resp['_items']
+        ]
+
+    def get_list_response(self, resp, items):
+        """Returns response of a list POST with results of the items in
+        `_items`. Eve responds to a list of a single item like to a POST
+        of the bare item.
+        """
+        if len(items) == 1 and '_items' not in resp:
+            return {'_status': resp.get('_status'), '_items': [resp]}
+        return resp
+
+    def _bisect(self, endpoint, items, resp):
+        """Sends halves of the failed batch separately to isolate the items
+        which made it fail.
+        """
+        if len(items) == 1:
+            self.log_failed(endpoint, items[0], resp)
+            return [None]
+        half = len(items) // 2
+        return self.batch_create(endpoint, items[:half]) + \
+            self.batch_create(endpoint, items[half:])
+
+    def get_error(self, e):
+        """Returns body of the error response of the API."""
+        try:
+            return e.response.json()
+        except ValueError:
+            raise e
+
+    def log_failed(self, endpoint, item, resp):
+        self.count('failed')
+        self.log('Failed to export %s %s: %s' % (
+            endpoint, json.dumps(item), resp.get('_issues', resp)), ERROR)
+
+    def get_remote_endpoint(self, scheme):
+        domain, category = scheme.split('/')
+        if category in ('committees', 'parties', 'chamber'):
+            return 'organizations'
+        return category
+
+    def resolve_remote_ids(self, refs):
+        """Resolves ids of the people and organizations referenced by
+        `refs` (dictionaries with scheme and identifier) which are known
+        from the identity map. Their documents are checked to still exist
+        by one query per endpoint and chunk, ids of missing documents are
+        forgotten so that they are looked up again.
+        """
+        keys = collections.defaultdict(set)
+        for ref in refs:
+            key = (ref['scheme'], ref['identifier'])
+            endpoint = self.get_remote_endpoint(ref['scheme'])
+            if "%s/%s" % key not in self._ids and \
+                    endpoint not in self._indexed:
+                keys[endpoint].add(key)
+
+        for endpoint, endpoint_keys in keys.items():
+            known = self.identity.get_many(endpoint, endpoint_keys)
+            existing = self.fetch_by_ids(
+                endpoint, list(set(known.values())), ['id'])
+            for key, pk in known.items():
+                if pk in existing:
+                    self._ids["%s/%s" % key] = pk
+                else:
+                    self.log('%s %s/%s does not exist anymore' % (
+                        endpoint, key[0], key[1]), DEBUG)
+                    self.identity.delete(endpoint, key)
 
     def get_remote_id(self, scheme, identifier):
         key = "%s/%s" % (scheme, identifier)
         if key in self._ids:
             return self._ids[key]
 
-        domain, category = scheme.split('/')
-        if category in ('committees', 'parties', 'chamber'):
-            endpoint = 'organizations'
-        else:
-            endpoint = category
+        endpoint = self.get_remote_endpoint(scheme)
+        if endpoint in self._indexed:
+            return None
+
+        self.resolve_remote_ids([{'scheme': scheme, 'identifier': identifier}])
+        if key in self._ids:
+            return self._ids[key]
 
-        resp = vpapi.get(endpoint, where={
+        resp = self.api.get(endpoint, where={
             'identifiers': {
                 '$elemMatch': {'scheme': scheme, 'identifier': identifier}
             }
-        })
+        }, projection=['id'])
 
         if resp['_items']:
             item = resp['_items'][0]
             self._ids[key] = item['id']
+            self.identity.set(endpoint, (scheme, identifier), item['id'])
             return item['id']
 
+    def index_remote_ids(self, endpoints=('people', 'organizations')):
+        """Loads ids and identifiers of all people and organizations of
+        the parliament, so that `get_remote_id()` resolves them without
+        further requests.
+        """
+        for endpoint in endpoints:
+            ids = {}
+            items = self.api.getall(
+                endpoint,
+                projection={'id': 1, 'identifiers': 1},
+                max_results=self.index_page_size,
+                prefetch=4
+            )
+            for item in items:
+                for i in item.get('identifiers', []):
+                    if 'scheme' not in i:
+                        continue
+                    key = "%s/%s" % (i['scheme'], i['identifier'])
+                    self._ids.setdefault(key, item['id'])
+                    ids.setdefault((i['scheme'], i['identifier']), item['id'])
+            self.identity.set_many(endpoint, ids)
+            self._indexed.add(endpoint)
+
     def make_chamber(self, index):
         raise NotImplementedError()
 
     def get_chamber(self, index=0):
-        if not self._chamber:
-            self._chamber = self.make_chamber(index)
-        return self._chamber
+        with self._chamber_lock:
+            if not self._chamber:
+                self._chamber = self.make_chamber(index)
+            return self._chamber
 
     def export_people(self):
         chamber = self.get_chamber()
         people = self.load_json('people')
 
-        for person in people:
-            resp = self.get_or_create('people', person)
+        def export_chunk(people_chunk):
+            responses = self.get_or_create_many('people', people_chunk)
             if self.single_chamber:
-                membership = {
+                memberships = [{
                     'person_id': resp['id'],
                     'organization_id': chamber['id']
-                }
-                self.get_or_create('memberships', membership)
+                } for resp in responses if resp is not None]
+                self.get_or_create_many('memberships', memberships)
+
+        self.for_each(export_chunk, self.batches('people', people))
 
     def export_organizations(self):
         chamber = self.get_chamber()
         organizations = self.load_json('organizations')
 
-        for organization in organizations:
-            if self.single_chamber and 'parent_id' not in organization:
-                organization['parent_id'] = chamber['id']
-            elif 'parent_id' in organization:
-                organization['parent_id'] = self.get_remote_id(
-                    scheme=organization['parent_id']['scheme'],
-                    identifier=organization['parent_id']['identifier']
-                )
-            self.get_or_create('organizations', organization)
+        def export_chunk(organizations_chunk):
+            self.resolve_remote_ids([
+                o['parent_id'] for o in organizations_chunk
+                if isinstance(o.get('parent_id'), dict)
+            ])
+            for organization in organizations_chunk:
+                if self.single_chamber and 'parent_id' not in organization:
+                    organization['parent_id'] = chamber['id']
+                elif 'parent_id' in organization:
+                    organization['parent_id'] = self.get_remote_id(
+                        scheme=organization['parent_id']['scheme'],
+                        identifier=organization['parent_id']['identifier']
+                    )
+            self.get_or_create_many('organizations', organizations_chunk)
+
+        self.for_each(export_chunk, self.batches('organizations', organizations))
 
     def export_memberships(self):
         memberships = self.load_json('memberships')
 
-        for item in memberships:
-            person_id = self.get_remote_id(
-                scheme=item['person_id']['scheme'],
-                identifier=item['person_id']['identifier'])
-            organization_id = self.get_remote_id(
-                scheme=item['organization_id']['scheme'],
-                identifier=item['organization_id']['identifier'])
-            if person_id and organization_id:
-                item['person_id'] = person_id
-                item['organization_id'] = organization_id
-                self.get_or_create('memberships', item)
+        def export_chunk(memberships_chunk):
+            self.resolve_remote_ids(
+                [m['person_id'] for m in memberships_chunk] +
+                [m['organization_id'] for m in memberships_chunk])
+            resolved = []
+            for item in memberships_chunk:
+                person_id = self.get_remote_id(
+                    scheme=item['person_id']['scheme'],
+                    identifier=item['person_id']['identifier'])
+                organization_id = self.get_remote_id(
+                    scheme=item['organization_id']['scheme'],
+                    identifier=item['organization_id']['identifier'])
+                if person_id and organization_id:
+                    item['person_id'] = person_id
+                    item['organization_id'] = organization_id
+                    resolved.append(item)
+            if resolved:
+                self.get_or_create_many('memberships', resolved)
+
+        self.for_each(export_chunk, self.batches('memberships', memberships))
 
     def export_events(self):
         chamber = self.get_chamber()
+        index = self.get_index('events')
         parent_events = self.load_json(
-            'events', exclude=lambda x: 'parent_id' in x)
+            'events', reader='parent-events',
+            field='parent_id', values=[None])
         child_events = self.load_json(
-            'events', exclude=lambda x: 'parent_id' not in x)
+            'events', reader='child-events', field='parent_id',
+            values=[v for v in index.values('parent_id') if v is not None])
 
-        for item in parent_events:
-            item['organization_id'] = chamber['id']
-            resp = self.get_or_create('events', item)
-            self.events_ids[item['identifier']] = resp['id']
+        def export_chunk(events_chunk):
+            for item in events_chunk:
+                item['organization_id'] = chamber['id']
+                if 'parent_id' in item:
+                    item['parent_id'] = self.events_ids[item['parent_id']]
+            responses = self.get_or_create_many('events', events_chunk)
+            for item, resp in zip(events_chunk, responses):
+                if resp is not None:
+                    self.events_ids[item['identifier']] = resp['id']
 
-        for item in child_events:
-            item['organization_id'] = chamber['id']
-            item['parent_id'] = self.events_ids[item['parent_id']]
-            resp = self.get_or_create('events', item)
-            self.events_ids[item['identifier']] = resp['id']
+        # all parent events are exported before their children
+        self.for_each(export_chunk, self.batches('events', parent_events))
+        self.for_each(export_chunk, self.batches('events', child_events))
 
     def export_motions(self):
         chamber = self.get_chamber()
         motions = self.load_json('motions')
-        motion_id = None
 
-        for item in motions:
-            item['organization_id'] = chamber['id']
-            if 'id' in item:
-                motion_id = item['id']
-                del item['id']
-            session_id = item.get('legislative_session_id')
-            if session_id:
-                item['legislative_session_id'] = self.events_ids[session_id]
-            resp = self.get_or_create('motions', item)
+        def export_chunk(motions_chunk):
+            motion_ids = []
+            for item in motions_chunk:
+                item['organization_id'] = chamber['id']
+                motion_ids.append(item.pop('id', None))
+                session_id = item.get('legislative_session_id')
+                if session_id:
+                    item['legislative_session_id'] = self.events_ids[session_id]
+            responses = self.get_or_create_many('motions', motions_chunk)
+
+            for motion_id, resp in zip(motion_ids, responses):
+                if motion_id and resp is not None:
+                    self.motions_ids[motion_id] = resp['id']
 
-            if motion_id:
-                self.motions_ids[motion_id] = resp['id']
+        self.for_each(export_chunk, self.batches('motions', motions))
 
     def export_votes(self):
         vote_events = self.load_json('vote-events')
-        votes = self.load_json('votes')
-        vote_events_ids = {}
-
-        for vote_event in vote_events:
-            local_identifier = vote_event['identifier']
-            del vote_event['identifier']
-
-            if 'motion_id' in vote_event:
-                vote_event['motion_id'] = self.motions_ids[vote_event['motion_id']]
-
-            session_id = vote_event.get('legislative_session_id')
-            if session_id:
-                vote_event['legislative_session_id'] = self.events_ids[session_id]
-
-            vote_event_resp = self.get_or_create(
-                'vote-events', vote_event, refresh=True)
-            # send votes only once, when vote event is created
-            if not vote_event_resp.get('votes'):
-                vote_events_ids[local_identifier] = vote_event_resp['id']
-
-        filter_func = lambda x: x['vote_event_id'] in vote_events_ids
-        for votes_chunk in chunks(votes, 400, filter_func):
-            for v in votes_chunk:
-                v['vote_event_id'] = vote_events_ids[v['vote_event_id']]
-                v['voter_id'] = self.get_remote_id(
-                        scheme=v['voter_id']['scheme'],
-                        identifier=v['voter_id']['identifier'])
-            self.batch_create('votes', votes_chunk)
+        # votes grouped by vote event in bounded memory, so that the roll
+        # call of each vote event is read at once
+        votes = SortedJsonLines(
+            self.get_filename('votes'), 'vote_event_id',
+            self.votes_sort_buffer_size)
+
+        def export_chunk(vote_events_chunk):
+            local_identifiers = []
+            for vote_event in vote_events_chunk:
+                local_identifiers.append(vote_event.pop('identifier'))
+
+                if 'motion_id' in vote_event:
+                    vote_event['motion_id'] = self.motions_ids[vote_event['motion_id']]
+
+                session_id = vote_event.get('legislative_session_id')
+                if session_id:
+                    vote_event['legislative_session_id'] = self.events_ids[session_id]
+
+            responses = self.get_or_create_many('vote-events', vote_events_chunk)
+            # whole roll calls are sent, several small ones by one request
+            batch = []
+            size = self.get_batch_size('votes', self.votes_batch_size)
+            for local_identifier, resp in zip(local_identifiers, responses):
+                if resp is None:
+                    continue
+                roll_call = votes.get(local_identifier)
+                self.count('read', len(roll_call))
+                # send votes only once, when vote event has none
+                if not roll_call or \
+                        not resp['_created'] and self.has_votes(resp['id']):
+                    continue
+                self.resolve_remote_ids([v['voter_id'] for v in roll_call])
+                for v in roll_call:
+                    v['vote_event_id'] = resp['id']
+                    v['voter_id'] = self.get_remote_id(
+                            scheme=v['voter_id']['scheme'],
+                            identifier=v['voter_id']['identifier'])
+                if batch and len(batch) + len(roll_call) > size.size:
+                    self.batch_create('votes', batch, self.votes_batch_size)
+                    batch = []
+                batch.extend(roll_call)
+            if batch:
+                self.batch_create('votes', batch, self.votes_batch_size)
+
+        try:
+            self.for_each(export_chunk, self.batches('vote-events', vote_events))
+        finally:
+            votes.close()
+
+    def has_votes(self, vote_event_id):
+        """Checks whether any vote of the vote event was exported, without
+        downloading its votes.
+        """
+        resp = self.api.get(
+            'votes',
+            where={'vote_event_id': vote_event_id},
+            projection={'id': 1},
+            max_results=1
+        )
+        return bool(resp['_items'])
 
     def export_speeches(self):
         speeches = self.load_json('speeches')
 
-        for speech in speeches:
-            if 'creator_id' in speech:
-                speech['creator_id'] = self.get_remote_id(
-                    scheme=speech['creator_id']['scheme'],
-                    identifier=speech['creator_id']['identifier'])
-            session_id = speech.get('event_id')
-            if session_id:
-                speech['event_id'] = self.events_ids[session_id]
-            self.get_or_create('speeches', speech)
+        def export_chunk(speeches_chunk):
+            self.resolve_remote_ids([
+                s['creator_id'] for s in speeches_chunk if 'creator_id' in s])
+            for speech in speeches_chunk:
+                if 'creator_id' in speech:
+                    speech['creator_id'] = self.get_remote_id(
+                        scheme=speech['creator_id']['scheme'],
+                        identifier=speech['creator_id']['identifier'])
+                session_id = speech.get('event_id')
+                if session_id:
+                    speech['event_id'] = self.events_ids[session_id]
+            self.get_or_create_many('speeches', speeches_chunk)
+
+        self.for_each(export_chunk, self.batches('speeches', speeches))
@@ -0,0 +1,55 @@
+import threading
+
+
+class AdaptiveBatchSize(object):
+    """Size of list requests adapted to the observed server latency. The
+    number of items grows additively while requests take less than
+    `target_latency` seconds and is halved when they take longer or the
+    request is too large (AIMD). Batches never exceed `max_bytes` of
+    serialized items.
+    """
+
+    def __init__(self, size, max_size=None, max_bytes=1024 * 1024,
+                 target_latency=2.0, min_size=1):
+        self.size = size
+        self.min_size = min_size
+        self.max_size = max_size or 10 * size
+        self.max_bytes = max_bytes
+        self.target_latency = target_latency
+        self.step = max(size // 10, 1)
+        self._lock = threading.Lock()
+
+    def split(self, sizes, start=0):
+        """Returns index of the end of the batch starting at `start`, given
+        serialized sizes of the items. The batch has at least one item.
+        """
+        with self._lock:
+            limit = self.size
+        end = start
+        total = 0
+        while end < len(sizes) and end - start < limit:
+            total += sizes[end]
+            if total > self.max_bytes and end > start:
+                break
+            end += 1
+        return end
+
+    def record(self, count, latency):
+        """Adapts the size to latency of a successful request of `count`
+        items.
+        """
+        with self._lock:
+            if latency > self.target_latency:
+                self.size = max(self.size // 2, self.min_size)
+            elif count >= self.size:
+                # grow only when the batches are full
+                self.size = min(self.size + self.step, self.max_size)
+
+    def shrink(self, length=None):
+        """Halves the size after a request which was too large and lowers
+        the limit of bytes below `length` of the request.
+        """
+        with self._lock:
+            self.size = max(self.size // 2, self.min_size)
+            if length is not None:
+                self.max_bytes = max(min(self.max_bytes, length - 1), 1)
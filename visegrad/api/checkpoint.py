@@ -0,0 +1,88 @@
+import threading
+
+import json
+
+import os
+
+from visegrad.utils import make_dirs
+
+
+class Checkpoint(object):
+    """Progress of an export stored in a JSON file, so that a failed
+    export can be resumed. For each stage it records whether it has
+    finished and the byte offsets up to which its input files were
+    exported. Maps of local to remote ids built by the stages are stored
+    along.
+
+    The checkpoint is valid only for the input files it was made for,
+    their sizes and modification times are recorded in `files`.
+    """
+
+    def __init__(self, filename, files):
+        self.filename = filename
+        self.files = files
+        self._lock = threading.Lock()
+        self.stages = {}
+        self.maps = {}
+
+    def get_signature(self):
+        signature = {}
+        for filename in self.files:
+            if os.path.exists(filename):
+                st = os.stat(filename)
+                signature[filename] = [st.st_size, int(st.st_mtime)]
+        return signature
+
+    def load(self):
+        """Loads the saved checkpoint, returns whether it is valid for the
+        current input files.
+        """
+        if not os.path.exists(self.filename):
+            return False
+        with open(self.filename, 'r') as f:
+            data = json.load(f)
+        if data.get('files') != self.get_signature():
+            return False
+        self.stages = data['stages']
+        self.maps = data['maps']
+        return True
+
+    def save(self, maps=None):
+        """Atomically writes the checkpoint, with the given id maps."""
+        with self._lock:
+            if maps is not None:
+                self.maps = dict((k, dict(v)) for k, v in maps.items())
+            data = {
+                'files': self.get_signature(),
+                'stages': self.stages,
+                'maps': self.maps,
+            }
+            make_dirs(self.filename)
+            tmp = self.filename + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.rename(tmp, self.filename)
+
+    def clear(self):
+        with self._lock:
+            self.stages = {}
+            self.maps = {}
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+
+    def get_stage(self, stage):
+        with self._lock:
+            return self.stages.setdefault(
+                stage, {'finished': False, 'offsets': {}})
+
+    def is_finished(self, stage):
+        return self.get_stage(stage)['finished']
+
+    def finish(self, stage):
+        self.get_stage(stage)['finished'] = True
+
+    def get_offset(self, stage, reader):
+        return self.get_stage(stage)['offsets'].get(reader, 0)
+
+    def set_offsets(self, stage, offsets):
+        self.get_stage(stage)['offsets'].update(offsets)
@@ -0,0 +1,151 @@
+import sqlite3
+
+import threading
+
+import hashlib
+
+import json
+
+from visegrad.utils import make_dirs
+
+
+def content_hash(item):
+    """Returns hash of canonical JSON representation of the item."""
+    data = json.dumps(item, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+class IdentityMap(object):
+    """Persistent mapping of natural keys of exported items to their ids
+    in the API, stored in a SQLite database. Mappings are grouped into
+    namespaces (usually API endpoints) and each namespace is loaded into
+    memory on its first use. Content hashes of the items as they were
+    last exported are stored the same way.
+
+    Keys may be any JSON serializable values.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._db = None
+        self._namespaces = {}
+        self._hashes = {}
+        self._lock = threading.RLock()
+
+    @property
+    def db(self):
+        with self._lock:
+            if self._db is None:
+                make_dirs(self.filename)
+                self._db = sqlite3.connect(
+                    self.filename, check_same_thread=False)
+                self._db.execute(
+                    'CREATE TABLE IF NOT EXISTS ids ('
+                    'namespace TEXT, key TEXT, id TEXT, '
+                    'PRIMARY KEY (namespace, key))'
+                )
+                self._db.execute(
+                    'CREATE TABLE IF NOT EXISTS hashes ('
+                    'namespace TEXT, key TEXT, hash TEXT, '
+                    'PRIMARY KEY (namespace, key))'
+                )
+            return self._db
+
+    def _load(self, namespace):
+        with self._lock:
+            if namespace not in self._namespaces:
+                rows = self.db.execute(
+                    'SELECT key, id FROM ids WHERE namespace = ?',
+                    (namespace,))
+                self._namespaces[namespace] = dict(rows)
+            return self._namespaces[namespace]
+
+    def _key(self, key):
+        return json.dumps(key, sort_keys=True)
+
+    def get(self, namespace, key):
+        return self._load(namespace).get(self._key(key))
+
+    def get_many(self, namespace, keys):
+        """Returns dictionary of ids of the known keys."""
+        ids = self._load(namespace)
+        result = {}
+        for key in keys:
+            pk = ids.get(self._key(key))
+            if pk is not None:
+                result[key] = pk
+        return result
+
+    def set(self, namespace, key, pk):
+        self.set_many(namespace, {key: pk})
+
+    def set_many(self, namespace, mapping):
+        with self._lock:
+            ids = self._load(namespace)
+            rows = []
+            for key, pk in mapping.items():
+                key = self._key(key)
+                if ids.get(key) != pk:
+                    ids[key] = pk
+                    rows.append((namespace, key, pk))
+            if rows:
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO ids VALUES (?, ?, ?)', rows)
+                self.db.commit()
+
+    def delete(self, namespace, key):
+        """Forgets the key, e.g. when its document was deleted from the
+        API.
+        """
+        key = self._key(key)
+        with self._lock:
+            self._load(namespace).pop(key, None)
+            self._load_hashes(namespace).pop(key, None)
+            self.db.execute(
+                'DELETE FROM ids WHERE namespace = ? AND key = ?',
+                (namespace, key))
+            self.db.execute(
+                'DELETE FROM hashes WHERE namespace = ? AND key = ?',
+                (namespace, key))
+            self.db.commit()
+
+    def _load_hashes(self, namespace):
+        with self._lock:
+            if namespace not in self._hashes:
+                rows = self.db.execute(
+                    'SELECT key, hash FROM hashes WHERE namespace = ?',
+                    (namespace,))
+                self._hashes[namespace] = dict(rows)
+            return self._hashes[namespace]
+
+    def get_hashes(self, namespace, keys):
+        """Returns dictionary of content hashes of the known keys."""
+        hashes = self._load_hashes(namespace)
+        result = {}
+        for key in keys:
+            h = hashes.get(self._key(key))
+            if h is not None:
+                result[key] = h
+        return result
+
+    def set_hashes(self, namespace, mapping):
+        with self._lock:
+            hashes = self._load_hashes(namespace)
+            rows = []
+            for key, h in mapping.items():
+                key = self._key(key)
+                if hashes.get(key) != h:
+                    hashes[key] = h
+                    rows.append((namespace, key, h))
+            if rows:
+                self.db.executemany(
+                    'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?)', rows)
+                self.db.commit()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+            self._namespaces = {}
+            self._hashes = {}
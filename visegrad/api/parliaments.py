@@ -7,8 +7,6 @@ import re
 
 import requests
 
-import vpapi
-
 from visegrad.api.base import VisegradApiExport
 from visegrad.utils import parse_me_pdf
 
@@ -17,6 +15,7 @@ class SkustinaMeApiExport(VisegradApiExport):
     parliament = 'me/skupstina'
     parliament_code = 'ME_SKUPSTINA'
     domain = 'skupstina.me'
+    stream_deferred = ('speeches',)
 
     def make_chamber(self, index):
         chamber = {
@@ -36,7 +35,8 @@ class SkustinaMeApiExport(VisegradApiExport):
             ur'(pred\u015bedavaju\u0107i )|(pred\u015bednik )|\
 (generalni sekretar )', re.U)
 
-        for p in vpapi.getall('people'):
+        for p in self.api.getall(
+                'people', prefetch=4, projection=['id', 'name']):
             name = self.normalize_name(p['name'])
             people[name] = p['id']
 
@@ -66,13 +66,14 @@ class SkustinaMeApiExport(VisegradApiExport):
                                 break
 
                         if creator_id is None:
-                            resp = vpapi.getfirst(
+                            resp = self.api.getfirst(
                                 'people', where={
                                     'name': {
                                         '$regex': s['creator'],
                                         'options': 'i'
                                     }
-                                }
+                                },
+                                projection=['id']
                             )
                             if resp is None:
                                 self.log('Person "%(creator)s" not found. \
@@ -81,7 +82,7 @@ Creating one' % s, WARNING)
                                     'name': s['creator'],
                                     'sources': text_speech['sources']
                                 }
-                                resp = vpapi.post('people', item)
+                                resp = self.api.post('people', item)
                             creator_id = resp['id']
 
                         people[creator] = creator_id
@@ -0,0 +1,220 @@
+import array
+
+import heapq
+
+import itertools
+
+import json
+
+import mmap
+
+import os
+
+import re
+
+import tempfile
+
+
+def get_field_pattern(field):
+    return re.compile(
+        r'"%s"\s*:\s*("(?:[^"\\]|\\.)*"|[-+\w.]+)' % re.escape(field))
+
+
+def get_field_value(line, field, pattern):
+    """Returns value of the top-level field of the JSON encoded line,
+    without decoding the rest of the line when possible. Values which are
+    not scalars are returned JSON encoded.
+    """
+    match = pattern.search(line)
+    if match is not None and line.count('"%s"' % field) == 1:
+        value = json.loads(match.group(1))
+    elif '"%s"' % field not in line:
+        return None
+    else:
+        # nested or not a scalar value
+        value = json.loads(line).get(field)
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value, sort_keys=True)
+    return value
+
+
+class JsonLinesIndex(object):
+    """Index of a JSON lines file, built by a single pass over the file.
+    It keeps offsets of all lines and, for each of the indexed top-level
+    fields, numbers of the lines grouped by value of the field. Lines are
+    then read through a memory-mapped file, so that only the selected
+    ones are decoded.
+
+    Values of the indexed fields are extracted from the raw lines without
+    decoding the rest of the item when possible, so names of the indexed
+    fields must not be used by nested objects.
+    """
+
+    def __init__(self, filename, fields=()):
+        self.filename = filename
+        self.fields = tuple(fields)
+        self.offsets = array.array('L')
+        self.index = dict((field, {}) for field in self.fields)
+        self._patterns = dict(
+            (field, get_field_pattern(field)) for field in self.fields)
+        self._file = None
+        self._mmap = None
+        self._build()
+
+    def _build(self):
+        if not os.path.exists(self.filename):
+            return
+        self._file = open(self.filename, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        if size:
+            self._mmap = mmap.mmap(
+                self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        offset = 0
+        for lineno, line in enumerate(iter(self._file.readline, '')):
+            self.offsets.append(offset)
+            offset += len(line)
+            for field in self.fields:
+                value = get_field_value(line, field, self._patterns[field])
+                lines = self.index[field].get(value)
+                if lines is None:
+                    lines = self.index[field][value] = array.array('L')
+                lines.append(lineno)
+        self.offsets.append(offset)
+
+    def __len__(self):
+        return max(len(self.offsets) - 1, 0)
+
+    def values(self, field):
+        """Returns distinct values of the indexed field."""
+        return self.index[field].keys()
+
+    def count(self, field, values):
+        return sum(len(self.index[field].get(v, ())) for v in values)
+
+    def get_lines(self, field=None, values=None):
+        """Returns numbers of lines, in the order of the file, whose `field`
+        has one of the `values`. All lines are returned by default.
+        """
+        if field is None:
+            return xrange(len(self))
+        groups = [
+            self.index[field][v] for v in set(values)
+            if v in self.index[field]
+        ]
+        return heapq.merge(*groups)
+
+    def read(self, lineno):
+        start, end = self.offsets[lineno], self.offsets[lineno + 1]
+        return json.loads(self._mmap[start:end])
+
+    def items(self, field=None, values=None, start=0):
+        """Yields `(end offset, item)` of the selected lines starting at
+        byte offset `start` or later.
+        """
+        for lineno in self.get_lines(field, values):
+            if self.offsets[lineno] >= start:
+                yield self.offsets[lineno + 1], self.read(lineno)
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class SortedJsonLines(object):
+    """Copy of a JSON lines file with its lines grouped by value of a
+    top-level field, made by an external merge sort. At most `buffer_size`
+    lines are held in memory: sorted runs of lines are written into
+    temporary files which are then merged. Only offsets of the groups are
+    kept, so items of a group are read by a single slice of the file.
+    """
+
+    def __init__(self, filename, field, buffer_size=100000):
+        self.filename = filename
+        self.field = field
+        self.buffer_size = buffer_size
+        self.groups = {}
+        self._pattern = get_field_pattern(field)
+        self._file = None
+        self._mmap = None
+        self._build()
+
+    def _build(self):
+        if not os.path.exists(self.filename):
+            return
+        directory = os.path.dirname(self.filename) or None
+        runs = []
+        try:
+            with open(self.filename, 'rb') as f:
+                while True:
+                    lines = list(itertools.islice(
+                        iter(f.readline, ''), self.buffer_size))
+                    if not lines:
+                        break
+                    runs.append(self._write_run(lines, directory))
+
+            self._file = tempfile.TemporaryFile(dir=directory)
+            offset = 0
+            for value, line in self._merge(runs):
+                if not line.endswith('\n'):
+                    line += '\n'
+                start, end = self.groups.get(value, (offset, offset))
+                if end != offset:
+                    raise ValueError('Sort of %s failed' % self.filename)
+                self._file.write(line)
+                offset += len(line)
+                self.groups[value] = (start, offset)
+            self._file.flush()
+            if offset:
+                self._mmap = mmap.mmap(
+                    self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            for run in runs:
+                run.close()
+
+    def _sort_key(self, line):
+        value = get_field_value(line, self.field, self._pattern)
+        return json.dumps(value), value
+
+    def _write_run(self, lines, directory):
+        run = tempfile.TemporaryFile(dir=directory)
+        keyed = sorted(
+            (self._sort_key(line), n) for n, line in enumerate(lines))
+        for (key, value), n in keyed:
+            line = lines[n]
+            if not line.endswith('\n'):
+                line += '\n'
+            run.write(line)
+        run.seek(0)
+        return run
+
+    def _merge(self, runs):
+        def read(run, n):
+            for line in iter(run.readline, ''):
+                key, value = self._sort_key(line)
+                yield key, n, value, line
+
+        for key, n, value, line in heapq.merge(
+                *[read(run, n) for n, run in enumerate(runs)]):
+            yield value, line
+
+    def values(self):
+        return self.groups.keys()
+
+    def get(self, value):
+        """Returns items whose field has the value."""
+        if value not in self.groups:
+            return []
+        start, end = self.groups[value]
+        return [json.loads(line) for line in self._mmap[start:end].splitlines()]
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,479 @@
+import BaseHTTPServer
+
+import SocketServer
+
+import collections
+
+import gzip
+
+import hashlib
+
+import json
+
+import re
+
+import threading
+
+import time
+
+import urlparse
+
+import uuid
+
+from StringIO import StringIO
+
+
+RESOURCES = ('people', 'organizations', 'memberships', 'events', 'motions',
+             'vote-events', 'votes', 'speeches', 'logs')
+
+# fields embedded as the referenced document
+EMBEDDED_REFS = {
+    'person': 'people',
+    'voter': 'people',
+    'creator': 'people',
+    'organization': 'organizations',
+    'parent': None,
+    'motion': 'motions',
+    'vote_event': 'vote-events',
+    'event': 'events',
+    'legislative_session': 'events',
+}
+
+# fields embedded as the list of documents referencing the document
+EMBEDDED_LISTS = {
+    ('vote-events', 'votes'): ('votes', 'vote_event_id'),
+    ('people', 'memberships'): ('memberships', 'person_id'),
+    ('organizations', 'memberships'): ('memberships', 'organization_id'),
+    ('events', 'speeches'): ('speeches', 'event_id'),
+}
+
+
+def get_values(doc, path):
+    """Returns values of the dotted `path` in the document, lists on the
+    path are traversed. A list value is returned along with its elements.
+    """
+    values = [doc]
+    for key in path.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, list):
+                found.extend(
+                    v[key] for v in value
+                    if isinstance(v, dict) and key in v
+                )
+            elif isinstance(value, dict) and key in value:
+                found.append(value[key])
+        values = found
+    result = []
+    for value in values:
+        if isinstance(value, list):
+            result.extend(value)
+        result.append(value)
+    return result
+
+
+def match_condition(values, op, arg, options=''):
+    scalars = [v for v in values if not isinstance(v, list)]
+    if op == '$exists':
+        return bool(values) == bool(arg)
+    elif op == '$in':
+        return any(v in arg for v in scalars)
+    elif op == '$nin':
+        return not any(v in arg for v in scalars)
+    elif op == '$ne':
+        return arg not in values
+    elif op == '$gt':
+        return any(v > arg for v in scalars)
+    elif op == '$gte':
+        return any(v >= arg for v in scalars)
+    elif op == '$lt':
+        return any(v < arg for v in scalars)
+    elif op == '$lte':
+        return any(v <= arg for v in scalars)
+    elif op == '$elemMatch':
+        return any(
+            isinstance(e, dict) and match(e, arg)
+            for v in values if isinstance(v, list) for e in v
+        )
+    elif op == '$regex':
+        flags = re.I if 'i' in options else 0
+        return any(
+            isinstance(v, basestring) and re.search(arg, v, flags)
+            for v in scalars
+        )
+    raise ValueError('Unsupported operator %s' % op)
+
+
+def match(doc, where):
+    """Returns whether the document matches the MongoDB query `where`."""
+    for key, condition in where.items():
+        if key == '$and':
+            if not all(match(doc, w) for w in condition):
+                return False
+        elif key == '$or':
+            if not any(match(doc, w) for w in condition):
+                return False
+        elif isinstance(condition, dict) and \
+                any(k.startswith('$') for k in condition):
+            values = get_values(doc, key)
+            for op, arg in condition.items():
+                if op == 'options':
+                    continue
+                if not match_condition(
+                        values, op, arg, condition.get('options', '')):
+                    return False
+        elif condition not in get_values(doc, key):
+            return False
+    return True
+
+
+def get_etag(doc):
+    return hashlib.sha1(json.dumps(doc, sort_keys=True)).hexdigest()
+
+
+class ApiRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handles requests of the subset of Eve API used by the exporters."""
+
+    protocol_version = 'HTTP/1.1'
+    # seconds an idle keep-alive connection is kept open
+    timeout = 30
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message, issues=None):
+        data = {
+            '_status': 'ERR',
+            '_error': {'code': status, 'message': message},
+        }
+        if issues is not None:
+            data['_issues'] = issues
+        self.send_json(status, data)
+
+    def send_empty(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def parse_path(self):
+        """Returns collection path, resource, document id and query of the
+        request. The collection path includes the parliament.
+        """
+        url = urlparse.urlparse(self.path)
+        parts = [p for p in url.path.split('/') if p]
+        query = dict(
+            (k, v[0]) for k, v in urlparse.parse_qs(url.query).items())
+        pk = None
+        if parts and parts[-1] not in RESOURCES:
+            pk = parts.pop()
+        if not parts or parts[-1] not in RESOURCES:
+            return None, None, None, query
+        return '/'.join(parts), parts[-1], pk, query
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.GzipFile(fileobj=StringIO(body)).read()
+        return json.loads(body)
+
+    def handle_request(self, method):
+        path, resource, pk, query = self.parse_path()
+        self.server.count_request(self.command, resource)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if path is None or len(self.path) > self.server.max_url_length:
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if path is not None:
+                return self.send_error_json(414, 'Request-URI Too Long')
+            return self.send_error_json(404, 'The requested URL was not found')
+        try:
+            method(path, resource, pk, query)
+        except ValueError, e:
+            self.send_error_json(400, str(e))
+
+    def do_GET(self):
+        self.handle_request(self.get)
+
+    def do_POST(self):
+        self.handle_request(self.post)
+
+    def do_PUT(self):
+        self.handle_request(self.put)
+
+    def do_PATCH(self):
+        self.handle_request(self.patch)
+
+    def do_DELETE(self):
+        self.handle_request(self.delete)
+
+    def get_projection(self, query):
+        projection = json.loads(query.get('projection', '{}'))
+        if isinstance(projection, list):
+            projection = dict((field, 1) for field in projection)
+        return projection
+
+    def get_embedded(self, query):
+        embedded = json.loads(
+            query.get('embed', query.get('embedded', '[]')))
+        if isinstance(embedded, dict):
+            embedded = [k for k, v in embedded.items() if v]
+        return embedded
+
+    def render(self, path, resource, doc, projection=None, embedded=()):
+        """Returns the document as sent by the API."""
+        store = self.server.store
+        parliament = path[:-len(resource)]
+        included = [k for k, v in (projection or {}).items() if v]
+        excluded = [k for k, v in (projection or {}).items() if not v]
+        data = {}
+        for key, value in doc.items():
+            if included and key not in included and key != 'id':
+                continue
+            if key in excluded:
+                continue
+            data[key] = value
+        for field in embedded:
+            if (resource, field) in EMBEDDED_LISTS:
+                other, ref = EMBEDDED_LISTS[(resource, field)]
+                data[field] = [
+                    d for d in store.get(parliament + other).values()
+                    if d.get(ref) == doc['id']
+                ]
+            elif field in EMBEDDED_REFS and doc.get(field + '_id'):
+                other = EMBEDDED_REFS[field] or resource
+                embedded_doc = store.get(parliament + other).get(
+                    doc[field + '_id'])
+                if embedded_doc is not None:
+                    data[field] = embedded_doc
+        data['_etag'] = get_etag(doc)
+        data['_links'] = {'self': {
+            'href': '%s/%s' % (resource, doc['id']), 'title': resource}}
+        return data
+
+    def get(self, path, resource, pk, query):
+        store = self.server.store
+        projection = self.get_projection(query)
+        embedded = self.get_embedded(query)
+        with store.lock:
+            docs = store.get(path)
+            if pk is not None:
+                doc = docs.get(pk)
+                if doc is None:
+                    return self.send_error_json(404, 'Document not found')
+                etag = get_etag(doc)
+                if self.headers.get('If-None-Match') == etag:
+                    return self.send_empty(304)
+                return self.send_json(
+                    200, self.render(path, resource, doc, projection, embedded),
+                    {'ETag': etag})
+
+            where = json.loads(query.get('where', '{}'))
+            found = [doc for doc in docs.values() if match(doc, where)]
+            for key, direction in reversed(self.get_sort(query)):
+                found.sort(key=lambda d: get_values(d, key)[:1],
+                           reverse=direction < 0)
+            page = int(query.get('page', 1))
+            max_results = int(query.get('max_results', 25))
+            total = len(found)
+            items = [
+                self.render(path, resource, doc, projection, embedded)
+                for doc in found[(page - 1) * max_results:page * max_results]
+            ]
+        links = {}
+        if page * max_results < total:
+            links['next'] = {
+                'href': '%s?page=%d' % (resource, page + 1), 'title': 'next'}
+        self.send_json(200, {
+            '_items': items,
+            '_links': links,
+            '_meta': {
+                'page': page, 'max_results': max_results, 'total': total},
+        })
+
+    def get_sort(self, query):
+        """Returns list of (field, direction) of the `sort` parameter given
+        either in MongoDB syntax or as comma separated fields.
+        """
+        sort = query.get('sort')
+        if not sort:
+            return []
+        if sort.startswith('['):
+            return json.loads(sort)
+        return [
+            (field.lstrip('-'), -1 if field.startswith('-') else 1)
+            for field in sort.split(',')
+        ]
+
+    def validate(self, item):
+        if not isinstance(item, dict):
+            return {'document': 'must be of dict type'}
+        return None
+
+    def post(self, path, resource, pk, query):
+        body = self.read_body()
+        if pk is not None:
+            return self.send_error_json(405, 'The method is not allowed')
+        store = self.server.store
+        items = body if isinstance(body, list) else [body]
+        if not items:
+            return self.send_error_json(400, 'Empty bulk insert')
+
+        results = []
+        for item in items:
+            issues = self.validate(item)
+            if issues is None:
+                results.append({'_status': 'OK'})
+            else:
+                results.append({'_status': 'ERR', '_issues': issues})
+        if any(r['_status'] == 'ERR' for r in results):
+            # bulk inserts are all or nothing
+            if len(items) > 1:
+                return self.send_json(422, {
+                    '_status': 'ERR',
+                    '_error': {'code': 422, 'message': 'Insertion failure'},
+                    '_items': results,
+                })
+            return self.send_error_json(
+                422, 'Insertion failure', results[0]['_issues'])
+
+        new_docs = []
+        for item in items:
+            doc = dict(item)
+            doc['id'] = doc.get('id') or uuid.uuid4().hex[:24]
+            new_docs.append(doc)
+        with store.lock:
+            docs = store.get(path)
+            for doc in new_docs:
+                if doc['id'] in docs:
+                    return self.send_error_json(
+                        409, 'Duplicate id %s' % doc['id'])
+            for n, doc in enumerate(new_docs):
+                docs[doc['id']] = doc
+                results[n] = self.get_write_result(resource, doc)
+        # like Eve, a list of a single item is answered as the bare item
+        if len(items) > 1:
+            return self.send_json(201, {'_status': 'OK', '_items': results})
+        self.send_json(201, results[0])
+
+    def get_write_result(self, resource, doc):
+        return {
+            '_status': 'OK',
+            'id': doc['id'],
+            '_etag': get_etag(doc),
+            '_links': {'self': {
+                'href': '%s/%s' % (resource, doc['id']), 'title': resource}},
+        }
+
+    def put(self, path, resource, pk, query):
+        self.update(path, resource, pk, self.read_body(), replace=True)
+
+    def patch(self, path, resource, pk, query):
+        self.update(path, resource, pk, self.read_body(), replace=False)
+
+    def update(self, path, resource, pk, item, replace):
+        if pk is None:
+            return self.send_error_json(405, 'The method is not allowed')
+        issues = self.validate(item)
+        if issues is not None:
+            return self.send_error_json(422, 'Update failure', issues)
+        store = self.server.store
+        with store.lock:
+            docs = store.get(path)
+            if pk not in docs:
+                return self.send_error_json(404, 'Document not found')
+            if_match = self.headers.get('If-Match')
+            if if_match and if_match != get_etag(docs[pk]):
+                return self.send_error_json(412, 'Precondition failed')
+            doc = {} if replace else dict(docs[pk])
+            doc.update(item)
+            doc['id'] = pk
+            docs[pk] = doc
+        self.send_json(200, self.get_write_result(resource, doc))
+
+    def delete(self, path, resource, pk, query):
+        store = self.server.store
+        with store.lock:
+            docs = store.get(path)
+            if pk is None:
+                docs.clear()
+            elif docs.pop(pk, None) is None:
+                return self.send_error_json(404, 'Document not found')
+        self.send_empty(204)
+
+
+class Store(object):
+    """In-memory documents of the collections in their insertion order."""
+
+    def __init__(self):
+        self.collections = {}
+        self.lock = threading.RLock()
+
+    def get(self, path):
+        with self.lock:
+            return self.collections.setdefault(
+                path, collections.OrderedDict())
+
+    def count(self):
+        """Returns number of documents in each collection."""
+        with self.lock:
+            return dict(
+                (path, len(docs)) for path, docs in self.collections.items())
+
+
+class LocalApiServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local stand-in of the API keeping the documents in memory, for
+    benchmarks of the exporters. It implements the subset of Eve API used
+    by `vpapi` and the exporters: `where` queries, `sort`, `projection`,
+    `embed`, paging, list POST, PUT, PATCH and DELETE. Each request is
+    delayed by `latency` seconds to simulate a remote server. Requests
+    with URL longer than `max_url_length` are refused with 414, as by the
+    web servers in front of the API.
+
+    Authentication is not checked and the documents are not validated.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0,
+                 max_url_length=8000):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, (host, port), ApiRequestHandler)
+        self.latency = latency
+        self.max_url_length = max_url_length
+        self.store = Store()
+        self.requests = collections.Counter()
+        self._requests_lock = threading.Lock()
+        self._thread = None
+
+    def count_request(self, method, resource):
+        with self._requests_lock:
+            self.requests['%s %s' % (method, resource)] += 1
+
+    def reset_requests(self):
+        with self._requests_lock:
+            self.requests.clear()
+
+    def start(self):
+        """Serves requests in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
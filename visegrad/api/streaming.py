@@ -0,0 +1,328 @@
+from scrapy.log import INFO, ERROR
+
+import threading
+
+import collections
+
+import traceback
+
+import Queue
+
+import time
+
+
+class StreamingExport(object):
+    """Exports items to the API while they are being scraped.
+
+    Items are put into a bounded queue consumed by worker threads. Items
+    referencing a person, organization, event, motion or vote event which
+    is not known yet are buffered and exported as soon as the referenced
+    item is exported. Votes are collected per vote event and sent by list
+    requests when there are enough of them, after `flush_interval`
+    seconds or when the export is closed.
+
+    Endpoints listed in `stream_deferred` of the exporter are not streamed
+    and are exported by their regular stage when the export is closed.
+    """
+
+    def __init__(self, exporter, workers=4, queue_size=1000,
+                 flush_interval=60):
+        self.exporter = exporter
+        self.log = exporter.log
+        self.flush_interval = flush_interval
+        self.queue = Queue.Queue(queue_size)
+        self.refs = {}
+        self.pending = collections.defaultdict(list)
+        self.votes = {}
+        self.votes_since = {}
+        self._looked_up = set()
+        self._lock = threading.RLock()
+        self._votes_lock = threading.Lock()
+        self._threads = [
+            threading.Thread(target=self.work) for i in range(workers)]
+        self._endpoints = dict(
+            (filename[:-len('.json')], endpoint)
+            for endpoint, filename in exporter.FILES.items()
+        )
+
+    def start(self):
+        self.exporter.started = time.time()
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def put(self, item_type, item):
+        """Queues the item of the given type (item class name), blocking
+        while the queue is full.
+        """
+        endpoint = self._endpoints.get(item_type)
+        if endpoint is None or endpoint in self.exporter.stream_deferred:
+            return
+        self.queue.put((endpoint, item))
+
+    def close(self):
+        """Waits until all queued items are exported, sends buffered votes
+        and runs the deferred stages. Items whose references were never
+        resolved are counted as failed and fail the export.
+        """
+        self.queue.join()
+        for thread in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+        # references of people and organizations created elsewhere
+        for ref in list(self.pending):
+            if ref[0] == 'id' and ref not in self.refs:
+                self.resolve_id(ref, force=True)
+        unresolved = sum(len(items) for items in self.pending.values())
+        if unresolved:
+            self.log('%d items with unresolved references were not \
+exported: %s' % (unresolved, ', '.join(
+                '%s %s' % ref for ref in self.pending)), ERROR)
+            for items in self.pending.values():
+                for endpoint, item in items:
+                    self.exporter._local.stage = endpoint
+                    self.exporter.count('failed')
+
+        self.flush_votes()
+        for name, stats in sorted(self.exporter.stats.items()):
+            self.log('Exported %s: %d created, %d updated, %d skipped, \
+%d failed' % (name, stats['created'], stats['updated'], stats['skipped'],
+                stats['failed']), INFO)
+
+        status = 'failed'
+        try:
+            for stage in self.exporter.stream_deferred:
+                name, method, inputs, outputs = [
+                    s for s in self.exporter.STAGES if s[0] == stage][0]
+                self.exporter.run_stage(name, getattr(self.exporter, method))
+            errors = sum(s['errors'] for s in self.exporter.stats.values())
+            if errors or unresolved:
+                raise Exception('Streaming export failed with %d errors and \
+%d unresolved items' % (errors, unresolved))
+            status = 'finished'
+        finally:
+            self.exporter.identity.close()
+            self.exporter.dump_metrics()
+            self.exporter.write_report(status)
+
+    def work(self):
+        while True:
+            try:
+                task = self.queue.get(timeout=1)
+            except Queue.Empty:
+                self.flush_votes(self.flush_interval)
+                continue
+            try:
+                if task is None:
+                    break
+                self.exporter._local.stage = task[0]
+                self.exporter.count('read')
+                self.export(*task)
+            finally:
+                self.queue.task_done()
+
+    def export(self, endpoint, item):
+        self.exporter._local.stage = endpoint
+        try:
+            for ref in self.get_refs(endpoint, item):
+                self.resolve(ref)
+            with self._lock:
+                missing = [
+                    ref for ref in self.get_refs(endpoint, item)
+                    if ref not in self.refs
+                ]
+                if missing:
+                    self.pending[missing[0]].append((endpoint, item))
+                    return
+            getattr(self, 'export_%s' % endpoint.replace('-', '_'))(item)
+        except Exception:
+            self.log(traceback.format_exc(), ERROR)
+            self.exporter.count('errors')
+
+    def get_refs(self, endpoint, item):
+        """Returns references of the item which must be resolved before
+        it is exported.
+        """
+        refs = []
+        id_fields = {
+            'organizations': ('parent_id',),
+            'memberships': ('person_id', 'organization_id'),
+            'votes': ('voter_id',),
+            'speeches': ('creator_id',),
+        }
+        for field in id_fields.get(endpoint, ()):
+            if isinstance(item.get(field), dict):
+                refs.append(
+                    ('id', '%(scheme)s/%(identifier)s' % item[field]))
+        if endpoint == 'events' and 'parent_id' in item:
+            refs.append(('event', item['parent_id']))
+        if endpoint in ('motions', 'vote-events') and \
+                item.get('legislative_session_id'):
+            refs.append(('event', item['legislative_session_id']))
+        if endpoint == 'speeches' and item.get('event_id'):
+            refs.append(('event', item['event_id']))
+        if endpoint == 'vote-events' and 'motion_id' in item:
+            refs.append(('motion', item['motion_id']))
+        if endpoint == 'votes':
+            refs.append(('vote-event', item['vote_event_id']))
+        return refs
+
+    def resolve(self, ref):
+        if ref in self.refs:
+            return
+        if ref[0] == 'id':
+            self.resolve_id(ref)
+        elif ref[0] == 'event':
+            pk = self.exporter.events_ids.get(ref[1])
+            if pk is None:
+                pk = self.exporter.identity.get('events', ref[1])
+            if pk is not None:
+                self.resolved(ref, pk)
+
+    def resolve_id(self, ref, force=False):
+        """Resolves person or organization reference. The API is asked
+        only once for each of them unless `force` is set.
+        """
+        if ref in self._looked_up and not force:
+            return
+        self._looked_up.add(ref)
+        scheme, identifier = ref[1].rsplit('/', 1)
+        pk = self.exporter.get_remote_id(scheme, identifier)
+        if pk is not None:
+            self.resolved(ref, pk)
+
+    def resolved(self, ref, pk):
+        """Records remote id of the reference and exports items waiting
+        for it.
+        """
+        with self._lock:
+            self.refs[ref] = pk
+            waiting = self.pending.pop(ref, [])
+        for endpoint, item in waiting:
+            self.export(endpoint, item)
+
+    def resolved_ids(self, item, pk):
+        for i in item.get('identifiers', []):
+            if 'scheme' in i:
+                key = '%(scheme)s/%(identifier)s' % i
+                self.exporter._ids[key] = pk
+                self.resolved(('id', key), pk)
+
+    def export_people(self, item):
+        resp = self.exporter.get_or_create_many('people', [item])[0]
+        if resp is None:
+            return
+        if self.exporter.single_chamber:
+            membership = {
+                'person_id': resp['id'],
+                'organization_id': self.exporter.get_chamber()['id']
+            }
+            self.exporter.get_or_create_many('memberships', [membership])
+        self.resolved_ids(item, resp['id'])
+
+    def export_organizations(self, item):
+        if isinstance(item.get('parent_id'), dict):
+            item['parent_id'] = self.refs[
+                ('id', '%(scheme)s/%(identifier)s' % item['parent_id'])]
+        elif self.exporter.single_chamber and 'parent_id' not in item:
+            item['parent_id'] = self.exporter.get_chamber()['id']
+        resp = self.exporter.get_or_create_many('organizations', [item])[0]
+        if resp is not None:
+            self.resolved_ids(item, resp['id'])
+
+    def export_memberships(self, item):
+        for field in ('person_id', 'organization_id'):
+            item[field] = self.refs[
+                ('id', '%(scheme)s/%(identifier)s' % item[field])]
+        self.exporter.get_or_create_many('memberships', [item])
+
+    def export_events(self, item):
+        item['organization_id'] = self.exporter.get_chamber()['id']
+        if 'parent_id' in item:
+            item['parent_id'] = self.refs[('event', item['parent_id'])]
+        resp = self.exporter.get_or_create_many('events', [item])[0]
+        if resp is not None:
+            self.exporter.events_ids[item['identifier']] = resp['id']
+            self.resolved(('event', item['identifier']), resp['id'])
+
+    def export_motions(self, item):
+        item['organization_id'] = self.exporter.get_chamber()['id']
+        motion_id = item.pop('id', None)
+        session_id = item.get('legislative_session_id')
+        if session_id:
+            item['legislative_session_id'] = self.refs[('event', session_id)]
+        resp = self.exporter.get_or_create_many('motions', [item])[0]
+        if resp is not None and motion_id:
+            self.exporter.motions_ids[motion_id] = resp['id']
+            self.resolved(('motion', motion_id), resp['id'])
+
+    def export_vote_events(self, item):
+        local_identifier = item.pop('identifier')
+        if 'motion_id' in item:
+            item['motion_id'] = self.refs[('motion', item['motion_id'])]
+        session_id = item.get('legislative_session_id')
+        if session_id:
+            item['legislative_session_id'] = self.refs[('event', session_id)]
+        resp = self.exporter.get_or_create_many('vote-events', [item])[0]
+        if resp is None:
+            return
+        # send votes only once, when vote event has none
+        if resp['_created'] or not self.exporter.has_votes(resp['id']):
+            self.resolved(('vote-event', local_identifier), resp['id'])
+        else:
+            self.resolved(('vote-event', local_identifier), None)
+
+    def export_votes(self, item):
+        vote_event_id = self.refs[('vote-event', item['vote_event_id'])]
+        if vote_event_id is None:
+            return
+        item['vote_event_id'] = vote_event_id
+        item['voter_id'] = self.refs[
+            ('id', '%(scheme)s/%(identifier)s' % item['voter_id'])]
+
+        with self._votes_lock:
+            votes = self.votes.setdefault(vote_event_id, [])
+            self.votes_since.setdefault(vote_event_id, time.time())
+            votes.append(item)
+            size = self.exporter.get_batch_size(
+                'votes', self.exporter.votes_batch_size)
+            if len(votes) < size.size:
+                return
+            del self.votes[vote_event_id]
+            del self.votes_since[vote_event_id]
+        self.exporter.batch_create(
+            'votes', votes, self.exporter.votes_batch_size)
+
+    def flush_votes(self, older_than=None):
+        """Sends buffered votes collected for more than `older_than`
+        seconds, all of them by default.
+        """
+        now = time.time()
+        with self._votes_lock:
+            flushed = [
+                pk for pk, since in self.votes_since.items()
+                if older_than is None or now - since >= older_than
+            ]
+            batches = []
+            for pk in flushed:
+                batches.append(self.votes.pop(pk))
+                del self.votes_since[pk]
+        self.exporter._local.stage = 'votes'
+        for votes in batches:
+            try:
+                self.exporter.batch_create(
+                    'votes', votes, self.exporter.votes_batch_size)
+            except Exception:
+                self.log(traceback.format_exc(), ERROR)
+                self.exporter.count('errors')
+
+    def export_speeches(self, item):
+        if isinstance(item.get('creator_id'), dict):
+            item['creator_id'] = self.refs[
+                ('id', '%(scheme)s/%(identifier)s' % item['creator_id'])]
+        session_id = item.get('event_id')
+        if session_id:
+            item['event_id'] = self.refs[('event', session_id)]
+        self.exporter.get_or_create_many('speeches', [item])
@@ -0,0 +1,11 @@
+from visegrad.api import parliaments
+from visegrad.api.base import VisegradApiExport
+
+
+def get_exporters():
+    """Returns exporter classes by domain of the parliament."""
+    return dict(
+        (cls.domain, cls) for cls in vars(parliaments).values()
+        if isinstance(cls, type) and issubclass(cls, VisegradApiExport)
+        and cls.domain
+    )
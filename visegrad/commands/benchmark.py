@@ -0,0 +1,112 @@
+from __future__ import print_function
+
+import glob
+
+import os
+
+import shutil
+
+import tempfile
+
+import time
+
+import scrapy.log
+from scrapy.command import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+import vpapi
+
+from visegrad.api.server import LocalApiServer
+from visegrad.commands import get_exporters
+
+
+class Command(ScrapyCommand):
+    """Replays scraped files of a parliament through the exporter against
+    a local in-memory API server and reports throughput and number of API
+    requests of each run. The first run exports into an empty API, the
+    following ones re-export the same files.
+    """
+
+    requires_project = True
+    default_settings = {'LOG_LEVEL': 'WARNING'}
+
+    def syntax(self):
+        return '[options] <domain>'
+
+    def short_desc(self):
+        return 'Benchmark export of scraped data/<domain>/ files'
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_option('--latency', type='float', default=0.0,
+                          help='seconds each API request is delayed by')
+        parser.add_option('--runs', type='int', default=2,
+                          help='number of exports of the files (default 2)')
+        parser.add_option('--data', metavar='DIR',
+                          help='directory with scraped files of the domain '
+                               '(default OUTPUT_PATH/<domain>)')
+
+    def run(self, args, opts):
+        exporters = get_exporters()
+        if len(args) != 1 or args[0] not in exporters:
+            raise UsageError('Domain must be one of: %s' %
+                             ', '.join(sorted(exporters)))
+        exporter_class = exporters[args[0]]
+        data = opts.data or os.path.join(
+            self.settings.get('OUTPUT_PATH', ''), exporter_class.domain)
+        if not os.path.isdir(data):
+            raise UsageError('Directory %s does not exist' % data)
+
+        # exports are run on a copy, so that the identity map, checkpoint
+        # and report of the benchmark do not overwrite the real ones
+        output = tempfile.mkdtemp()
+        os.mkdir(os.path.join(output, exporter_class.domain))
+        for filename in glob.glob(os.path.join(data, '*.json')):
+            shutil.copy(filename, os.path.join(output, exporter_class.domain))
+        self.settings.set('OUTPUT_PATH', output, priority='cmdline')
+        password = 'VPAPI_PWD_%s' % exporter_class.parliament_code.upper()
+        if not self.settings.get(password):
+            self.settings.set(password, 'benchmark', priority='cmdline')
+        scrapy.log.start_from_settings(self.settings)
+
+        server = LocalApiServer(latency=opts.latency)
+        server.start()
+        vpapi.SERVER_NAME = '%s:%d' % server.server_address
+        try:
+            for run in range(opts.runs):
+                self.run_export(exporter_class, server, run)
+        finally:
+            server.stop()
+            shutil.rmtree(output)
+
+    def run_export(self, exporter_class, server, run):
+        server.reset_requests()
+        exporter = exporter_class()
+        started = time.time()
+        try:
+            exporter.run_export(resume=False)
+        finally:
+            # idle keep-alive connections would hold the server threads
+            exporter.api.close()
+            self.print_report(exporter, server, run, time.time() - started)
+
+    def print_report(self, exporter, server, run, seconds):
+        requests = sum(server.requests.values())
+        print('Run %d (%s): %s in %.2f s, %d requests (%.1f per second)' % (
+            run + 1, 'cold' if run == 0 else 'warm',
+            exporter.report['status'], seconds, requests,
+            requests / seconds if seconds else 0))
+        print('  %-14s %8s %8s %8s %8s %9s %10s' % (
+            'stage', 'read', 'written', 'requests', 'seconds', 'items/s',
+            'kB sent'))
+        for name, stats in sorted(exporter.report['stages'].items()):
+            written = sum(
+                stats[k] for k in ('created', 'updated', 'skipped'))
+            print('  %-14s %8d %8d %8d %8.2f %9s %10.1f' % (
+                name, stats['read'], written, stats['requests'],
+                stats['seconds'],
+                '%.1f' % stats['items_per_second']
+                if stats['items_per_second'] is not None else '-',
+                stats['bytes_sent'] / 1024.0))
+        for request, count in sorted(server.requests.items()):
+            print('  %-30s %8d' % (request, count))
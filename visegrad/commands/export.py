@@ -0,0 +1,40 @@
+import scrapy.log
+from scrapy.command import ScrapyCommand
+from scrapy.exceptions import UsageError
+
+from visegrad.commands import get_exporters
+
+
+class Command(ScrapyCommand):
+    """Exports already scraped files of a parliament to the API without
+    crawling, e.g. to resume an export which failed after the crawl.
+    """
+
+    requires_project = True
+    default_settings = {'LOG_LEVEL': 'INFO'}
+
+    def syntax(self):
+        return '[options] <domain>'
+
+    def short_desc(self):
+        return 'Export scraped data/<domain>/ files to the API'
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_option('--resume', action='store_true',
+                          help='continue from the checkpoint of the last '
+                               'failed export of the same files')
+
+    def run(self, args, opts):
+        exporters = get_exporters()
+        if len(args) != 1 or args[0] not in exporters:
+            raise UsageError('Domain must be one of: %s' %
+                             ', '.join(sorted(exporters)))
+        scrapy.log.start_from_settings(self.settings)
+
+        exporter = exporters[args[0]]()
+        try:
+            exporter.run_export(resume=opts.resume or None)
+        except Exception, e:
+            exporter.log(e.message, scrapy.log.ERROR)
+            self.exitcode = 1
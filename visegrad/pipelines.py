@@ -7,6 +7,10 @@ from scrapy.log import ERROR
 
 import os
 
+import json
+
+from visegrad.api.streaming import StreamingExport
+
 
 class DuplicatesPipeline(object):
     def __init__(self):
@@ -34,6 +38,7 @@ class ExportPipeline(object):
     def __init__(self):
         self.files = {}
         self.exporters = {}
+        self.report = None
 
         dispatcher.connect(self.spider_closed, signals.spider_closed)
 
@@ -60,11 +65,19 @@ class ExportPipeline(object):
         return self.exporters[filename]
 
     def spider_closed(self, spider, reason):
+        self.close_files()
+        status = self.get_status(spider, reason)
+        if status == 'finished' and spider.exporter_class:
+            status = self.export(spider)
+        spider.log_finish(status, self.report)
+
+    def close_files(self):
         for filename in self.files:
             if filename in self.exporters:
                 self.exporters[filename].finish_exporting()
             self.files[filename].close()
 
+    def get_status(self, spider, reason):
         status = 'finished' if reason == 'finished' else 'failed'
 
         max_errors = settings.get('CLOSESPIDER_ERRORCOUNT')
@@ -72,17 +85,76 @@ class ExportPipeline(object):
 
         if max_errors and errors_count >= max_errors:
             status = 'failed'
-
-        if status == 'finished' and spider.exporter_class:
-            exporter = spider.exporter_class(log=spider.log)
-            try:
-                exporter.run_export()
-            except Exception, e:
-                spider.log(e.message, ERROR)
-                status = 'failed'
-        spider.log_finish(status)
+        return status
+
+    def export(self, spider):
+        """Exports the scraped files to the API and returns the status."""
+        exporter = spider.exporter_class(log=spider.log)
+        try:
+            exporter.run_export()
+        except Exception, e:
+            spider.log(e.message, ERROR)
+            return 'failed'
+        finally:
+            self.report = exporter.report
+        return 'finished'
 
     def process_item(self, item, spider):
         self.get_exporter(spider, item).export_item(item)
 
         return item
+
+
+class StreamingExportPipeline(ExportPipeline):
+    """Exports items to the API while crawling, besides writing them into
+    the files.
+    """
+
+    def __init__(self):
+        super(StreamingExportPipeline, self).__init__()
+        self.stream = None
+
+        dispatcher.connect(self.spider_opened, signals.spider_opened)
+
+    def spider_opened(self, spider):
+        if spider.exporter_class:
+            self.stream = StreamingExport(
+                spider.exporter_class(log=spider.log),
+                workers=settings.getint('STREAMING_EXPORT_WORKERS', 4),
+                queue_size=settings.getint('STREAMING_EXPORT_QUEUE_SIZE', 1000),
+                flush_interval=settings.getint(
+                    'STREAMING_EXPORT_FLUSH_INTERVAL', 60)
+            )
+            self.stream.start()
+
+    def spider_closed(self, spider, reason):
+        self.close_files()
+        status = self.get_status(spider, reason)
+        if self.stream is not None:
+            # items streamed so far are exported even if the crawl failed
+            export_status = self.export(spider)
+            if status == 'finished':
+                status = export_status
+        spider.log_finish(status, self.report)
+
+    def export(self, spider):
+        try:
+            self.stream.close()
+        except Exception, e:
+            spider.log(e.message, ERROR)
+            return 'failed'
+        finally:
+            self.report = self.stream.exporter.report
+        return 'finished'
+
+    def process_item(self, item, spider):
+        exporter = self.get_exporter(spider, item)
+        exporter.export_item(item)
+
+        if self.stream is not None:
+            # the same serialization as written into the files
+            fields = dict(exporter._get_serialized_fields(item))
+            self.stream.put(
+                item.__class__.__name__,
+                json.loads(exporter.encoder.encode(fields)))
+        return item
@@ -10,6 +10,7 @@ BOT_NAME = 'visegrad'
 
 SPIDER_MODULES = ['visegrad.spiders']
 NEWSPIDER_MODULE = 'visegrad.spiders'
+COMMANDS_MODULE = 'visegrad.commands'
 
 ITEM_PIPELINES = {
     'visegrad.pipelines.DuplicatesPipeline': 800,
@@ -27,6 +28,56 @@ CLOSESPIDER_ERRORCOUNT = 1
 
 CRAWL_LATEST_ONLY = 0
 
+# Number of keep-alive connections to the API kept by the exporter
+VPAPI_POOL_SIZE = 10
+
+# Number of retries of API requests failed by a connection error or
+# a temporary server error (429, 502, 503 and 504 responses)
+VPAPI_RETRIES = 5
+
+# Maximum number of API requests per second sent by the exporter
+# (0 for no limit), lowered automatically when the API throttles it
+VPAPI_RATE_LIMIT = 0
+
+# Request bodies of at least this number of bytes are sent compressed by
+# gzip (0 disables it, the API server must accept gzip encoded requests)
+VPAPI_COMPRESS_THRESHOLD = 0
+
+# Number of API GET responses cached by the exporter (0 disables the cache)
+# and number of seconds they are considered fresh. Export rarely repeats
+# a query, so the cache is disabled by default.
+VPAPI_CACHE_SIZE = 0
+VPAPI_CACHE_TTL = 300
+
+# How the exporter updates existing documents: 'put' replaces them,
+# 'patch' sends only fields which changed; fields dropped from the scraped
+# items are not removed from the documents in 'patch' mode
+VPAPI_UPDATE_MODE = 'put'
+
+# Whether items unchanged since their last export are skipped without any
+# request to the API; turn off to send them again, e.g. after documents were
+# deleted from the API
+VPAPI_SKIP_UNCHANGED = True
+
+# Number of worker threads exporting items of a stage concurrently
+VPAPI_EXPORT_CONCURRENCY = 1
+
+# Whether export stages not depending on each other run in parallel
+VPAPI_EXPORT_PARALLEL_STAGES = True
+
+# Whether the export continues from the checkpoint of the last failed export
+# of the same files instead of starting over; a crawl rewrites the files, so
+# a failed export is resumed by 'scrapy export <domain> --resume'
+VPAPI_EXPORT_RESUME = False
+
+# Items are exported to the API while crawling when
+# 'visegrad.pipelines.StreamingExportPipeline' replaces ExportPipeline in
+# ITEM_PIPELINES; number of its worker threads, maximum number of queued
+# items and number of seconds votes are buffered before they are sent
+STREAMING_EXPORT_WORKERS = 4
+STREAMING_EXPORT_QUEUE_SIZE = 1000
+STREAMING_EXPORT_FLUSH_INTERVAL = 60
+
 try:
     import json
     import os.path
@@ -2,11 +2,14 @@ import scrapy
 from scrapy.conf import settings
 from scrapy import signals
 from scrapy.xlib.pydispatch import dispatcher
+from scrapy.log import WARNING
 
 from datetime import datetime
 
 import vpapi
 
+import requests
+
 
 class VisegradSpider(scrapy.Spider):
     exporter_class = None
@@ -17,8 +20,8 @@ class VisegradSpider(scrapy.Spider):
     def __init__(self, *args, **kwargs):
         super(VisegradSpider, self).__init__(*args, **kwargs)
 
-        vpapi.parliament(self.get_parliament())
-        vpapi.authorize(self.get_user(), self.get_password())
+        self.api = vpapi.Client(
+            self.get_parliament(), (self.get_user(), self.get_password()))
 
         dispatcher.connect(self.spider_opened, signals.spider_opened)
 
@@ -31,10 +34,21 @@ class VisegradSpider(scrapy.Spider):
         }
         if settings.get('LOG_FILE'):
             log_item['file'] = settings['LOG_FILE']
-        self._log = vpapi.post('logs', log_item)
-
-    def log_finish(self, status):
-        vpapi.patch('logs/%s' % self._log['id'], {'status': status})
+        self._log = self.api.post('logs', log_item)
+
+    def log_finish(self, status, report=None):
+        """Records the final status and the export report in the log."""
+        log_item = {'status': status}
+        if report is not None:
+            log_item['report'] = report
+        try:
+            self.api.patch('logs/%s' % self._log['id'], log_item)
+        except requests.HTTPError:
+            if report is None:
+                raise
+            # the API may not accept reports
+            self.log('Export report was not recorded', WARNING)
+            self.api.patch('logs/%s' % self._log['id'], {'status': status})
 
     def get_parliament(self):
         default_endpoint = '/'.join(self.parliament_code.lower().split('_'))
@@ -48,7 +62,8 @@ class VisegradSpider(scrapy.Spider):
         return settings.get(var)
 
     def get_latest_item(self, endpoint, time_key):
-        return vpapi.getfirst(endpoint, sort='-%s' % time_key)
+        return self.api.getfirst(
+            endpoint, sort='-%s' % time_key, projection=[time_key])
 
     def get_latest_date(self, endpoint, time_key):
         if not settings.get('CRAWL_LATEST_ONLY'):
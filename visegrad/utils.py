@@ -1,5 +1,7 @@
 import itertools
 
+import os
+
 import subprocess
 
 import re
@@ -45,6 +47,13 @@ def chunks(iterator, size=50, filter_func=None):
         chunk = list(itertools.islice(filtered_iterator, size))
 
 
+def make_dirs(filename):
+    """Creates missing directories of the file."""
+    dirs = os.path.dirname(filename)
+    if dirs and not os.path.exists(dirs):
+        os.makedirs(dirs)
+
+
 def parse_me_pdf(filename):
     pdf_parser = subprocess.Popen(
         ['pdftotext', filename, '-'], stdout=subprocess.PIPE)
@@ -1,43 +1,67 @@
 import json
 import base64
+import threading
+import collections
+import random
+import email.utils
+import zlib
+import time as _time
+from multiprocessing.pool import ThreadPool
 from datetime import datetime, date, time
 
 import requests
+import requests.adapters
 import pytz
 
 """Visegrad+ parliament API client module.
 Contains functions for sending API requests conveniently.
+
+Module level functions use a default client shared by the whole process.
+Independent clients with their own parliament, credentials and timezone
+(e.g. for exporting several parliaments in parallel threads) can be
+created by instantiating `vpapi.Client`.
 """
 
 __all__ = [
-	'parliament', 'authorize', 'deauthorize',
+	'Client', 'ResponseCache', 'RetryPolicy', 'RateLimiter', 'Metrics',
+	'parliament', 'metrics', 'authorize', 'deauthorize', 'pool',
 	'get', 'getall', 'getfirst', 'post', 'put', 'patch', 'delete',
 	'timezone', 'utc_to_local', 'local_to_utc',
 ]
 
 SERVER_NAME = 'api.parldata.eu'
 SERVER_CERT = 'server_cert.pem'
-PARLIAMENT = ''
-LOCAL_TIMEZONE = None
 PAYLOAD_HEADERS = {
 	'Content-Type': 'application/json',
 }
-
-
-def _endpoint(resource, method):
-	"""Returns URL of the given resource and method.
-	http:// is used for GET method while https:// for the others.
-	http:// is used for all methods on localhost.
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = 10
+POOL_BLOCK = False
+RETRY_STATUSES = (429, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+# upper bounds of latency histogram buckets in milliseconds
+LATENCY_BUCKETS = (
+	1, 2, 5, 10, 20, 50, 100, 200, 500,
+	1000, 2000, 5000, 10000, 20000, 60000, float('inf')
+)
+
+
+def _gzip(data):
+	"""Returns `data` compressed in gzip format."""
+	compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	return compressor.compress(data) + compressor.flush()
+
+
+def _projection(fields):
+	"""Returns projection parameter of a query. Fields to return may be
+	given as a list (or a single field name), a dictionary is returned
+	unchanged.
 	"""
-	if method=='GET' or SERVER_NAME.startswith('localhost:') or SERVER_NAME.startswith('127.0.0.1:'):
-		protocol = 'http'
-	else:
-		protocol = 'https'
-	if PARLIAMENT:
-		url = '%s://%s/%s/%s' % (protocol, SERVER_NAME, PARLIAMENT, resource)
-	else:
-		url = '%s://%s/%s' % (protocol, SERVER_NAME, resource)
-	return url
+	if isinstance(fields, basestring):
+		fields = [fields]
+	if isinstance(fields, (list, tuple, set)):
+		return dict((f, 1) for f in fields)
+	return fields
 
 
 def _jsonify_dict_values(params):
@@ -50,75 +74,778 @@ def _jsonify_dict_values(params):
 	}
 
 
+class ResponseCache(object):
+	"""In-process cache of GET responses with LRU eviction and time to
+	live. Responses are keyed by resource and normalized lookup parameters.
+	Stale entries are revalidated by conditional requests using ETag and
+	Last-Modified headers of the cached response. All entries of a resource
+	are dropped when the resource is modified through the same client.
+
+	Usage:
+		api = vpapi.Client('pl/sejm', cache=vpapi.ResponseCache(1000, 60))
+	"""
+
+	def __init__(self, maxsize=1024, ttl=60):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.hits = 0
+		self.misses = 0
+		self.revalidations = 0
+		self._entries = collections.OrderedDict()
+		self._lock = threading.Lock()
+
+	def key(self, resource, params):
+		return (resource.strip('/'), json.dumps(params, sort_keys=True))
+
+	def lookup(self, key):
+		"""Returns content of the cached response if it is fresh and
+		None otherwise. In the latter case headers for a conditional
+		request revalidating the stale entry are returned as well.
+		"""
+		with self._lock:
+			entry = self._entries.pop(key, None)
+			if entry is None:
+				return None, {}
+			self._entries[key] = entry
+			stored_at, etag, last_modified, content = entry
+			if _time.time() - stored_at < self.ttl:
+				self.hits += 1
+				return content, {}
+		headers = {}
+		if etag:
+			headers['If-None-Match'] = etag
+		if last_modified:
+			headers['If-Modified-Since'] = last_modified
+		return None, headers
+
+	def revalidated(self, key):
+		"""Marks the cached response as fresh again after the server
+		responded by 304 Not Modified and returns its content.
+		"""
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is None:
+				return None
+			entry[0] = _time.time()
+			self.hits += 1
+			self.revalidations += 1
+			return entry[3]
+
+	def store(self, key, resp):
+		"""Stores content of the response, evicting the least recently
+		used entries if the cache is full.
+		"""
+		entry = [
+			_time.time(),
+			resp.headers.get('ETag'),
+			resp.headers.get('Last-Modified'),
+			resp.content
+		]
+		with self._lock:
+			self.misses += 1
+			self._entries.pop(key, None)
+			self._entries[key] = entry
+			while len(self._entries) > self.maxsize:
+				self._entries.popitem(last=False)
+
+	def invalidate(self, resource):
+		"""Drops all cached responses of the given resource (collection)."""
+		collection = resource.strip('/').split('/')[0]
+		with self._lock:
+			for key in list(self._entries):
+				if key[0].split('/')[0] == collection:
+					del self._entries[key]
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+
+	def stats(self):
+		"""Returns dictionary with cache hit and miss counters."""
+		with self._lock:
+			return {
+				'hits': self.hits,
+				'misses': self.misses,
+				'revalidations': self.revalidations,
+				'size': len(self._entries),
+			}
+
+
+class RetryPolicy(object):
+	"""Policy of retrying failed requests with exponential backoff and
+	full jitter. A delay requested by the server in `Retry-After` header
+	is honoured.
+
+	Idempotent methods are retried after connection errors and responses
+	with any of `statuses`. Other methods (POST, PATCH) might have been
+	processed already in such cases, so they are retried only if the
+	connection could not be established or the server refused to process
+	the request (429 Too Many Requests and 503 Service Unavailable),
+	unless `retry_non_idempotent` is set.
+	"""
+
+	def __init__(self, retries=5, backoff=0.5, max_backoff=60,
+			statuses=RETRY_STATUSES, retry_non_idempotent=False):
+		self.retries = retries
+		self.backoff = backoff
+		self.max_backoff = max_backoff
+		self.statuses = statuses
+		self.retry_non_idempotent = retry_non_idempotent
+
+	def should_retry(self, method, attempt, resp=None, error=None):
+		"""Returns whether a request which failed by `error` or by the
+		response `resp` on the given attempt (counted from 0) should be
+		sent again.
+		"""
+		if attempt >= self.retries:
+			return False
+		idempotent = method in IDEMPOTENT_METHODS or self.retry_non_idempotent
+		if error is not None:
+			return idempotent or self._not_sent(error)
+		if resp.status_code not in self.statuses:
+			return False
+		return idempotent or resp.status_code in (429, 503)
+
+	def _not_sent(self, error):
+		"""Returns whether the request failed before it was sent."""
+		if isinstance(error, requests.exceptions.ConnectTimeout):
+			return True
+		reason = getattr(error.args[0], 'reason', None) if error.args else None
+		return type(reason).__name__ in ('NewConnectionError', 'ConnectTimeoutError')
+
+	def delay(self, attempt, resp=None):
+		"""Returns number of seconds to wait before the next attempt."""
+		retry_after = resp.headers.get('Retry-After') if resp is not None else None
+		if retry_after:
+			if retry_after.strip().isdigit():
+				return float(retry_after)
+			parsed = email.utils.parsedate_tz(retry_after)
+			if parsed is not None:
+				return max(email.utils.mktime_tz(parsed) - _time.time(), 0)
+		return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+class RateLimiter(object):
+	"""Token bucket limiting the rate of requests to `rate` per second
+	with bursts of up to `burst` requests. It is shared by all threads
+	sending requests through a client.
+
+	The rate adapts to the server: it is halved whenever the server
+	throttles the client (429 or 503 responses) and recovers by a tenth of
+	the configured rate per second of successful requests.
+	"""
+
+	def __init__(self, rate, burst=None):
+		self.max_rate = float(rate)
+		self.rate = float(rate)
+		self.burst = burst or max(int(rate), 1)
+		self.tokens = float(self.burst)
+		self.updated = _time.time()
+		self._lock = threading.Lock()
+
+	def _refill(self, now):
+		elapsed = now - self.updated
+		self.updated = now
+		self.tokens = min(self.tokens + elapsed * self.rate, self.burst)
+		self.rate = min(self.rate + elapsed * self.max_rate / 10, self.max_rate)
+
+	def acquire(self):
+		"""Waits until a request may be sent."""
+		with self._lock:
+			self._refill(_time.time())
+			self.tokens -= 1
+			wait = -self.tokens / self.rate if self.tokens < 0 else 0
+		if wait:
+			_time.sleep(wait)
+
+	def throttled(self):
+		"""Slows down after the server refused a request for its rate."""
+		with self._lock:
+			self._refill(_time.time())
+			self.rate = max(self.rate / 2, self.max_rate / 100)
+
+
+class Metrics(object):
+	"""Counters of requests sent by a client per method and resource
+	(collection): number of requests, bytes sent and received, status codes
+	and histogram of latencies. Recording a request costs just a few
+	counter updates, so metrics are always collected.
+
+	Callbacks added by `add_callback()` are called for each request
+	(including each retry) from the thread which sent it with arguments
+	`method, resource, status, latency, sent, received`; status is None
+	if no response was received.
+	"""
+
+	def __init__(self):
+		self._endpoints = {}
+		self._callbacks = []
+		self._lock = threading.Lock()
+
+	def add_callback(self, func):
+		self._callbacks.append(func)
+
+	def remove_callback(self, func):
+		self._callbacks.remove(func)
+
+	def record(self, method, resource, status, latency, sent, received):
+		collection = resource.strip('/').split('/')[0]
+		latency_ms = latency * 1000
+		bucket = 0
+		while latency_ms > LATENCY_BUCKETS[bucket]:
+			bucket += 1
+		with self._lock:
+			stats = self._endpoints.get((method, collection))
+			if stats is None:
+				stats = self._endpoints[(method, collection)] = {
+					'count': 0,
+					'bytes_sent': 0,
+					'bytes_received': 0,
+					'statuses': {},
+					'histogram': [0] * len(LATENCY_BUCKETS),
+					'latency_sum': 0.0,
+					'latency_max': 0.0,
+				}
+			stats['count'] += 1
+			stats['bytes_sent'] += sent
+			stats['bytes_received'] += received
+			stats['statuses'][status] = stats['statuses'].get(status, 0) + 1
+			stats['histogram'][bucket] += 1
+			stats['latency_sum'] += latency_ms
+			stats['latency_max'] = max(stats['latency_max'], latency_ms)
+		for func in self._callbacks:
+			func(method, collection, status, latency, sent, received)
+
+	def _percentile(self, histogram, count, q, maximum):
+		"""Returns upper bound of the histogram bucket containing the
+		`q` quantile, at most the `maximum` observed latency.
+		"""
+		seen = 0
+		for bound, n in zip(LATENCY_BUCKETS, histogram):
+			seen += n
+			if seen >= q * count:
+				return min(bound, maximum)
+		return maximum
+
+	def snapshot(self):
+		"""Returns dictionary of metrics keyed by 'METHOD resource' with
+		latencies in milliseconds.
+		"""
+		result = {}
+		with self._lock:
+			for (method, collection), stats in self._endpoints.items():
+				count = stats['count']
+				histogram = stats['histogram']
+				maximum = stats['latency_max']
+				result['%s %s' % (method, collection)] = {
+					'count': count,
+					'bytes_sent': stats['bytes_sent'],
+					'bytes_received': stats['bytes_received'],
+					'statuses': dict(
+						(str(k), v) for k, v in stats['statuses'].items()),
+					'latency': {
+						'mean': stats['latency_sum'] / count,
+						'max': stats['latency_max'],
+						'p50': self._percentile(histogram, count, 0.5, maximum),
+						'p95': self._percentile(histogram, count, 0.95, maximum),
+						'p99': self._percentile(histogram, count, 0.99, maximum),
+					},
+				}
+		return result
+
+	def dump(self, filename):
+		"""Writes the snapshot of metrics into a JSON file."""
+		with open(filename, 'w') as f:
+			json.dump(self.snapshot(), f, indent=2, sort_keys=True)
+
+	def reset(self):
+		with self._lock:
+			self._endpoints = {}
+
+
+class Client(object):
+	"""Client of the API holding its own parliament, credentials,
+	local timezone and pool of keep-alive connections.
+
+	Usage:
+		api = vpapi.Client('pl/sejm', ('scraper', 'secret'))
+		for p in api.getall('people'):
+			...
+
+	Requests of a single client may be sent from several threads.
+	`server_name` and `server_cert` default to module level
+	`SERVER_NAME` and `SERVER_CERT` values. GET responses are cached
+	if a `ResponseCache` instance is given as `cache`. Failed requests
+	are retried according to `retry` policy (`RetryPolicy()` by default,
+	None disables retries) and the rate of requests is limited by
+	`rate_limiter` if given.
+
+	Requests are counted by `metrics` (a new `Metrics` instance by
+	default). Request bodies of at least `compress_threshold` bytes are sent
+	compressed by gzip if the threshold is given; the server must accept
+	`Content-Encoding: gzip`. Compressed responses are always accepted and
+	decoded incrementally while they are being read.
+
+	`thread_context` may be set to a function called in the thread calling
+	`getall()` with `prefetch`, it returns a function called in each of the
+	threads fetching the pages, e.g. to copy thread local state for the
+	metrics callbacks.
+	"""
+
+	thread_context = None
+
+	def __init__(self, parliament='', auth=None, timezone=None,
+			server_name=None, server_cert=None,
+			pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE,
+			pool_block=POOL_BLOCK, cache=None, retry=RetryPolicy(),
+			rate_limiter=None, compress_threshold=None, metrics=None):
+		self._parliament = parliament
+		self.metrics = metrics if metrics is not None else Metrics()
+		self.compress_threshold = compress_threshold
+		self.cache = cache
+		self.retry = retry
+		self.rate_limiter = rate_limiter
+		self.server_name = server_name
+		self.server_cert = server_cert
+		self.headers = dict(PAYLOAD_HEADERS)
+		self.local_timezone = None
+		self.pool_connections = pool_connections
+		self.pool_maxsize = pool_maxsize
+		self.pool_block = pool_block
+		self._session = None
+		self._lock = threading.Lock()
+		if auth is not None:
+			self.authorize(*auth)
+		if timezone is not None:
+			self.timezone(timezone)
+
+	def _endpoint(self, resource, method):
+		"""Returns URL of the given resource and method.
+		http:// is used for GET method while https:// for the others.
+		http:// is used for all methods on localhost.
+		"""
+		server_name = self.server_name or SERVER_NAME
+		if method=='GET' or server_name.startswith('localhost:') or server_name.startswith('127.0.0.1:'):
+			protocol = 'http'
+		else:
+			protocol = 'https'
+		if self._parliament:
+			url = '%s://%s/%s/%s' % (protocol, server_name, self._parliament, resource)
+		else:
+			url = '%s://%s/%s' % (protocol, server_name, resource)
+		return url
+
+	def session(self):
+		"""Returns HTTP session of the client, creating it on the first use.
+		The session keeps connections to the server alive and reuses them
+		(including established TLS sessions) for the following requests.
+		"""
+		with self._lock:
+			if self._session is None:
+				adapter = requests.adapters.HTTPAdapter(
+					pool_connections=self.pool_connections,
+					pool_maxsize=self.pool_maxsize,
+					pool_block=self.pool_block
+				)
+				session = requests.Session()
+				session.headers['Accept-Encoding'] = 'gzip, deflate'
+				session.mount('http://', adapter)
+				session.mount('https://', adapter)
+				session.verify = self.server_cert or SERVER_CERT
+				self._session = session
+			return self._session
+
+	def pool(self, connections=None, maxsize=None, block=None):
+		"""Configures the connection pool used by the following requests.
+		`connections` is the number of hosts to keep pools for, `maxsize`
+		the number of connections kept alive per host and `block` whether
+		a request should wait for a free connection when all are in use.
+		Already open connections are closed.
+		"""
+		with self._lock:
+			if connections is not None:
+				self.pool_connections = connections
+			if maxsize is not None:
+				self.pool_maxsize = maxsize
+			if block is not None:
+				self.pool_block = block
+			if self._session is not None:
+				self._session.close()
+				self._session = None
+		return self.session()
+
+	def close(self):
+		"""Closes all connections kept alive by the client."""
+		with self._lock:
+			if self._session is not None:
+				self._session.close()
+				self._session = None
+
+	def parliament(self, parl=None):
+		"""Sets the parliament the following requests will be sent to.
+		Returns previous, now overwritten value.
+		Used without arguments returns current value without any change.
+		"""
+		old = self._parliament
+		if parl is not None:
+			self._parliament = parl
+		self.session()
+		return old
+
+	def authorize(self, username, password):
+		"""Sets API username and password for the following data modifying
+		requests.
+		"""
+		s = '%s:%s' % (username, password)
+		self.headers['Authorization'] = b'Basic ' + base64.b64encode(s.encode('ascii'))
+		self.session()
+
+	def deauthorize(self):
+		"""Unsets API username and password - the following data modifying
+		requests will be anonymous.
+		"""
+		self.headers.pop('Authorization', None)
+
+	def _request(self, method, resource, params=None, data=None, headers=None):
+		"""Sends the request and returns the checked response."""
+		kwargs = {}
+		if params:
+			kwargs['params'] = _jsonify_dict_values(params)
+		if method != 'GET':
+			kwargs['headers'] = dict(self.headers, **(headers or {}))
+		elif headers:
+			kwargs['headers'] = headers
+		if data is not None:
+			kwargs['data'] = json.dumps(data)
+			if self.compress_threshold is not None and \
+					len(kwargs['data']) >= self.compress_threshold:
+				kwargs['data'] = _gzip(kwargs['data'])
+				kwargs['headers']['Content-Encoding'] = 'gzip'
+		sent = len(kwargs.get('data', ''))
+		attempt = 0
+		while True:
+			if self.rate_limiter is not None:
+				self.rate_limiter.acquire()
+			started = _time.time()
+			try:
+				resp = self.session().request(
+					method, self._endpoint(resource, method), **kwargs)
+			except (requests.ConnectionError, requests.Timeout), e:
+				self.metrics.record(
+					method, resource, None, _time.time() - started, sent, 0)
+				if self.retry is None or not self.retry.should_retry(
+						method, attempt, error=e):
+					raise
+				delay = self.retry.delay(attempt)
+			else:
+				received = resp.headers.get('Content-Length')
+				self.metrics.record(
+					method, resource, resp.status_code, _time.time() - started,
+					sent, int(received) if received else len(resp.content))
+				if self.rate_limiter is not None and resp.status_code in (429, 503):
+					self.rate_limiter.throttled()
+				if self.retry is None or not self.retry.should_retry(
+						method, attempt, resp=resp):
+					break
+				delay = self.retry.delay(attempt, resp)
+				resp.close()
+			finally:
+				if method != 'GET' and self.cache is not None:
+					self.cache.invalidate(resource)
+			_time.sleep(delay)
+			attempt += 1
+		resp.raise_for_status()
+		return resp
+
+	def get(self, resource, **kwargs):
+		"""Makes a GET (read) request to the API.
+		Lookup parameters are specified as keyword arguments.
+		`projection` may be given as a list of fields to return.
+		"""
+		if 'projection' in kwargs:
+			kwargs['projection'] = _projection(kwargs['projection'])
+		if self.cache is None:
+			return self._request('GET', resource, params=kwargs).json()
+
+		key = self.cache.key(resource, kwargs)
+		content, headers = self.cache.lookup(key)
+		if content is None:
+			resp = self._request('GET', resource, params=kwargs, headers=headers)
+			if resp.status_code == 304:
+				content = self.cache.revalidated(key)
+				if content is None:
+					resp = self._request('GET', resource, params=kwargs)
+			if content is None:
+				self.cache.store(key, resp)
+				content = resp.content
+		return json.loads(content)
+
+	def getall(self, resource, prefetch=0, max_buffered_pages=None,
+			keyset=None, after=None, **kwargs):
+		"""Generator that generates sequence of all found results without paging.
+		Lookup parameters are specified as keyword arguments,
+		`projection` may be given as a list of fields to return.
+
+		If `prefetch` is given, the number of pages is read from the first
+		page and the remaining pages are fetched by `prefetch` concurrent
+		requests. Items are still generated in order and at most
+		`max_buffered_pages` pages (twice `prefetch` by default) are held
+		in memory at once.
+
+		If `keyset` is given (True for the 'id' field of the documents or
+		name of another unique field returned with them), results are
+		sorted by it and each page is requested by values of the key
+		greater than the last one instead of by page number, which keeps
+		deep pages of large collections fast. Broken iteration can be
+		resumed by passing the key of the last received item as `after`.
+		Prefetching is not used in this mode.
+
+		Usage:
+			items = vpapi.getall(resource, where={...})
+			for i in items:
+				...
+		"""
+		if keyset is True:
+			keyset = 'id'
+		if keyset is not None:
+			for item in self._getall_keyset(resource, keyset, after, kwargs):
+				yield item
+			return
+
+		resp = self.get(resource, page=1, **kwargs)
+		for item in resp['_items']:
+			yield item
+		if 'next' not in resp['_links']:
+			return
+
+		meta = resp.get('_meta', {})
+		if prefetch and 'total' in meta and meta.get('max_results'):
+			pages = (meta['total'] + meta['max_results'] - 1) // meta['max_results']
+			window = max(max_buffered_pages or 2 * prefetch, 1)
+			for page_resp in self._prefetch_pages(
+					resource, pages, prefetch, window, kwargs):
+				for item in page_resp['_items']:
+					yield item
+			return
+
+		page = 2
+		while True:
+			resp = self.get(resource, page=page, **kwargs)
+			for item in resp['_items']:
+				yield item
+			if 'next' not in resp['_links']: break
+			page += 1
+
+	def _getall_keyset(self, resource, key, after, params):
+		"""Generates all found results sorted by `key`, requesting each
+		page by the key greater than the last one (`after`).
+		"""
+		where = params.pop('where', None)
+		params['sort'] = [(key, 1)]
+		if 'projection' in params:
+			projection = _projection(params['projection'])
+			if any(projection.values()):
+				projection = dict(projection, **{key: 1})
+			params['projection'] = projection
+		while True:
+			query = dict(params)
+			if after is not None:
+				condition = {key: {'$gt': after}}
+				query['where'] = {'$and': [where, condition]} if where else condition
+			elif where:
+				query['where'] = where
+			resp = self.get(resource, **query)
+			for item in resp['_items']:
+				yield item
+			if not resp['_items'] or 'next' not in resp['_links']:
+				return
+			if key not in resp['_items'][-1]:
+				raise ValueError(
+					'Key %s of keyset pagination is missing in %s' % (key, resource))
+			after = resp['_items'][-1][key]
+
+	def _prefetch_pages(self, resource, pages, workers, window, params):
+		"""Generates responses of pages 2 to `pages` in order while
+		fetching them concurrently. At most `window` pages are requested
+		but not consumed yet.
+		"""
+		fetch = lambda page: self.get(resource, page=page, **params)
+		initializer = self.thread_context() if self.thread_context else None
+		thread_pool = ThreadPool(workers, initializer)
+		pending = collections.deque()
+		try:
+			next_page = 2
+			while next_page <= pages or pending:
+				while next_page <= pages and len(pending) < window:
+					pending.append(thread_pool.apply_async(fetch, (next_page,)))
+					next_page += 1
+				yield pending.popleft().get()
+		finally:
+			thread_pool.terminate()
+
+	def getfirst(self, resource, **kwargs):
+		"""Returns first found item or None if there is none.
+		Lookup parameters are specified as keyword arguments,
+		`projection` may be given as a list of fields to return.
+		"""
+		resp = self.get(resource, **kwargs)
+		if '_items' not in resp:
+			return resp
+		if resp['_items']:
+			return resp['_items'][0]
+		else:
+			return None
+
+	def post(self, resource, data, **kwargs):
+		"""Makes a POST (create) request to the API.
+		`data` contains dictionary with data of the entity(ies) to create
+		and eventual parameters may be specified as keyword arguments.
+		"""
+		return self._request('POST', resource, params=kwargs, data=data).json()
+
+	def put(self, resource, data, **kwargs):
+		"""Makes a PUT (replace) request to the API.
+		`data` contains dictionary with data of the replacing entity and
+		eventual parameters may be specified as keyword arguments.
+		"""
+		return self._request('PUT', resource, params=kwargs, data=data).json()
+
+	def patch(self, resource, data, **kwargs):
+		"""Makes a PATCH (update) request to the API.
+		`data` contains dictionary with fields to update and their values,
+		eventual parameters may be specified as keyword arguments.
+		"""
+		return self._request('PATCH', resource, params=kwargs, data=data).json()
+
+	def delete(self, resource):
+		"""Makes a DELETE request to the API."""
+		self._request('DELETE', resource)
+		return {}
+
+	def timezone(self, name):
+		"""Sets the local timezone to be used by `utc_to_local()` and
+		`local_to_utc()` helper methods.
+		"""
+		self.local_timezone = pytz.timezone(name)
+
+	def utc_to_local(self, val, to_string=None):
+		"""Converts datetime or its string representation in ISO 8601 format
+		from UTC time returned by API to local time. The local timezone must
+		be previously set by `timezone()` method.
+
+		Returns the result in the same type as input if `to_string` is not
+		given. String output or datetime output can be enforced by setting
+		`to_string` to True or False respectively.
+		"""
+		if self.local_timezone is None:
+			raise ValueError('The local timezone must be set first, use vpapi.timezone()')
+		format = '%Y-%m-%dT%H:%M:%S'
+		out = datetime.strptime(val, format) if isinstance(val, str) else val
+		if not isinstance(out, datetime):
+			raise TypeError('Only datetime object or ISO 8601 string can be converted')
+
+		out = pytz.utc.localize(out)
+		out = out.astimezone(self.local_timezone)
+
+		if to_string or to_string is None and isinstance(val, str):
+			return out.strftime(format)
+		else:
+			return out
+
+	def local_to_utc(self, val, to_string=True):
+		"""Converts datetime or its string representation in ISO 8601 format
+		from local time to UTC time required by API. The local timezone must
+		be previously set by `timezone()` method.
+
+		Returns the result in the same type as input if `to_string` is not
+		given. String output or datetime output can be enforced by setting
+		`to_string` to True or False respectively.
+		"""
+		if self.local_timezone is None:
+			raise ValueError('The local timezone must be set first, use vpapi.timezone()')
+		format = '%Y-%m-%dT%H:%M:%S'
+		out = datetime.strptime(val, format) if isinstance(val, str) else val
+		if not isinstance(out, datetime):
+			raise TypeError('Only datetime object or ISO 8601 string can be converted')
+
+		out = self.local_timezone.localize(out)
+		out = out.astimezone(pytz.utc)
+
+		if to_string or to_string is None and isinstance(val, str):
+			return out.strftime(format)
+		else:
+			return out
+
+
+# default client used by the module level functions
+_client = Client()
+
+
 def parliament(parl=None):
 	"""Sets the parliament the following requests will be sent to.
 	Returns previous, now overwritten value.
 	Used without arguments returns current value without any change.
 	"""
-	global PARLIAMENT
-	old = PARLIAMENT
-	if parl is not None:
-		PARLIAMENT = parl
-	return old
+	return _client.parliament(parl)
 
 
 def authorize(username, password):
 	"""Sets API username and password for the following data modifying
 	requests.
 	"""
-	s = '%s:%s' % (username, password)
-	PAYLOAD_HEADERS['Authorization'] = b'Basic ' + base64.b64encode(s.encode('ascii'))
+	_client.authorize(username, password)
 
 
 def deauthorize():
 	"""Unsets API username and password - the following data modifying
 	requests will be anonymous.
 	"""
-	PAYLOAD_HEADERS.pop('Authorization', None)
+	_client.deauthorize()
+
+
+def metrics():
+	"""Returns `Metrics` of requests sent by the module level functions."""
+	return _client.metrics
+
+
+def pool(connections=None, maxsize=None, block=None):
+	"""Configures the connection pool shared by the following requests.
+	See `Client.pool()`.
+	"""
+	return _client.pool(connections, maxsize, block)
 
 
 def get(resource, **kwargs):
 	"""Makes a GET (read) request to the API.
 	Lookup parameters are specified as keyword arguments.
+	`projection` may be given as a list of fields to return.
 	"""
-	resp = requests.get(
-		_endpoint(resource, 'GET'),
-		params=_jsonify_dict_values(kwargs),
-		verify=SERVER_CERT
-	)
-	resp.raise_for_status()
-	return resp.json()
+	return _client.get(resource, **kwargs)
 
 
-def getall(resource, **kwargs):
+def getall(resource, prefetch=0, max_buffered_pages=None, keyset=None,
+		after=None, **kwargs):
 	"""Generator that generates sequence of all found results without paging.
-	Lookup parameters are specified as keyword arguments.
+	Lookup parameters are specified as keyword arguments,
+	`projection` may be given as a list of fields to return.
+	See `Client.getall()` for description of concurrent page prefetching
+	and keyset pagination.
 
 	Usage:
 		items = vpapi.getall(resource, where={...})
 		for i in items:
 			...
 	"""
-	page = 1
-	while True:
-		resp = get(resource, page=page, **kwargs)
-		for item in resp['_items']:
-			yield item
-		if 'next' not in resp['_links']: break
-		page += 1
+	return _client.getall(
+		resource, prefetch, max_buffered_pages, keyset, after, **kwargs)
 
 
 def getfirst(resource, **kwargs):
 	"""Returns first found item or None if there is none.
-	Lookup parameters are specified as keyword arguments.
+	Lookup parameters are specified as keyword arguments,
+	`projection` may be given as a list of fields to return.
 	"""
-	resp = get(resource, **kwargs)
-	if '_items' not in resp:
-		return resp
-	if resp['_items']:
-		return resp['_items'][0]
-	else:
-		return None
+	return _client.getfirst(resource, **kwargs)
 
 
 def post(resource, data, **kwargs):
@@ -126,15 +853,7 @@ def post(resource, data, **kwargs):
 	`data` contains dictionary with data of the entity(ies) to create
 	and eventual parameters may be specified as keyword arguments.
 	"""
-	resp = requests.post(
-		_endpoint(resource, 'POST'),
-		params=_jsonify_dict_values(kwargs),
-		data=json.dumps(data),
-		headers=PAYLOAD_HEADERS,
-		verify=SERVER_CERT
-	)
-	resp.raise_for_status()
-	return resp.json()
+	return _client.post(resource, data, **kwargs)
 
 
 def put(resource, data, **kwargs):
@@ -142,15 +861,7 @@ def put(resource, data, **kwargs):
 	`data` contains dictionary with data of the replacing entity and
 	eventual parameters may be specified as keyword arguments.
 	"""
-	resp = requests.put(
-		_endpoint(resource, 'PUT'),
-		params=_jsonify_dict_values(kwargs),
-		data=json.dumps(data),
-		headers=PAYLOAD_HEADERS,
-		verify=SERVER_CERT
-	)
-	resp.raise_for_status()
-	return resp.json()
+	return _client.put(resource, data, **kwargs)
 
 
 def patch(resource, data, **kwargs):
@@ -158,81 +869,32 @@ def patch(resource, data, **kwargs):
 	`data` contains dictionary with fields to update and their values,
 	eventual parameters may be specified as keyword arguments.
 	"""
-	resp = requests.patch(
-		_endpoint(resource, 'PATCH'),
-		params=_jsonify_dict_values(kwargs),
-		data=json.dumps(data),
-		headers=PAYLOAD_HEADERS,
-		verify=SERVER_CERT
-	)
-	resp.raise_for_status()
-	return resp.json()
+	return _client.patch(resource, data, **kwargs)
 
 
 def delete(resource):
 	"""Makes a DELETE request to the API."""
-	resp = requests.delete(
-		_endpoint(resource, 'DELETE'),
-		headers=PAYLOAD_HEADERS,
-		verify=SERVER_CERT
-	)
-	resp.raise_for_status()
-	return {}
+	return _client.delete(resource)
 
 
 def timezone(name):
 	"""Sets the local timezone to be used by `utc_to_local()` and
 	`local_to_utc()` helper functions.
 	"""
-	global LOCAL_TIMEZONE
-	LOCAL_TIMEZONE = pytz.timezone(name)
+	_client.timezone(name)
 
 
 def utc_to_local(val, to_string=None):
 	"""Converts datetime or its string representation in ISO 8601 format
 	from UTC time returned by API to local time. The local timezone must
 	be previously set by `vpapi.timezone()` function.
-
-	Returns the result in the same type as input if `to_string` is not
-	given. String output or datetime output can be enforced by setting
-	`to_string` to True or False respectively.
 	"""
-	if LOCAL_TIMEZONE is None:
-		raise ValueError('The local timezone must be set first, use vpapi.timezone()')
-	format = '%Y-%m-%dT%H:%M:%S'
-	out = datetime.strptime(val, format) if isinstance(val, str) else val
-	if not isinstance(out, datetime):
-		raise TypeError('Only datetime object or ISO 8601 string can be converted')
-
-	out = pytz.utc.localize(out)
-	out = out.astimezone(LOCAL_TIMEZONE)
-
-	if to_string or to_string is None and isinstance(val, str):
-		return out.strftime(format)
-	else:
-		return out
+	return _client.utc_to_local(val, to_string)
 
 
 def local_to_utc(val, to_string=True):
 	"""Converts datetime or its string representation in ISO 8601 format
 	from local time to UTC time required by API. The local timezone must
 	be previously set by `vpapi.timezone()` function.
-
-	Returns the result in the same type as input if `to_string` is not
-	given. String output or datetime output can be enforced by setting
-	`to_string` to True or False respectively.
 	"""
-	if LOCAL_TIMEZONE is None:
-		raise ValueError('The local timezone must be set first, use vpapi.timezone()')
-	format = '%Y-%m-%dT%H:%M:%S'
-	out = datetime.strptime(val, format) if isinstance(val, str) else val
-	if not isinstance(out, datetime):
-		raise TypeError('Only datetime object or ISO 8601 string can be converted')
-
-	out = LOCAL_TIMEZONE.localize(out)
-	out = out.astimezone(pytz.utc)
-
-	if to_string or to_string is None and isinstance(val, str):
-		return out.strftime(format)
-	else:
-		return out
+	return _client.local_to_utc(val, to_string)